@@ -0,0 +1,109 @@
+import random
+import re
+import time
+import timeit
+
+import onion_layers
+from onion_layers import NumberedName, Context, NEXT_PREV_OPACITY, get_frames
+
+# Layer name parsing as it was done before NumberedName used a single
+# compiled regular expression and a cache.
+def from_layer_name_uncached(name):
+	name_nomask = re.sub(r' mask$', '', name)
+
+	is_mask = (name_nomask != name)
+
+	g = re.search(r'(\d+)$', name_nomask)
+	if g:
+		num = int(g.group(1))
+		width = len(g.group(1))
+	else:
+		num = None
+		width = None
+
+	name_nonum = re.sub(r'\d+$', '', name_nomask)
+
+	return NumberedName(name_nonum, num, width, is_mask)
+
+def get_layer_names(n):
+	# Names like in a shot with 2000 frames of 4 layers each. Onion
+	# functions parse the same names over and over again.
+	names = []
+	for i in range(n):
+		frame = (i // 5) % 2000
+		if i % 5 == 0:
+			names.append("frame%04d" % (frame*100,))
+		else:
+			name = [ "outline", "shading", "color", "sketch" ][i % 5 - 1]
+			names.append("%s%04d" % (name, frame*100))
+			if i % 50 == 1:
+				names[-1] += " mask"
+
+	return names
+
+def bench_parse(n=100000, repeat=5):
+	names = get_layer_names(n)
+
+	def parse_uncached():
+		for name in names:
+			from_layer_name_uncached(name)
+
+	def parse():
+		for name in names:
+			NumberedName.from_layer_name(name)
+
+	def parse_cold():
+		NumberedName._cache.clear()
+		parse()
+
+	for label, func in [
+			("uncached", parse_uncached),
+			("cold cache", parse_cold),
+			("warm cache", parse) ]:
+		t = min(timeit.repeat(func, number=1, repeat=repeat))
+		print("parse %d layer names, %-10s: %.3f s, %.0f names/s" % (n, label, t, n/t))
+
+def bench_splice(nframes=500, repeat=3):
+	# Uses the fake image model from the tests, so this measures the
+	# plug-in's own work and counts PDB calls, not GIMP's.
+	from tests import FakeGimpTestCase
+
+	class Bench(FakeGimpTestCase):
+		def runTest(self):
+			pass
+
+	best = None
+	for n in range(repeat):
+		bench = Bench()
+		bench.setUp()
+
+		rnd = random.Random(1)
+		img = bench.make_image(rnd, 2000, sub_layers=4)
+		src_img = bench.make_image(rnd, nframes, sub_layers=4)
+
+		# Splice in the middle of the shot, where frames are numbered
+		# by 100, so some following frames need to be renumbered.
+		i = 1000
+		onion_layers.onion_unsafe(img, img.active_layer, 0,
+				Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], i))
+		img.active_layer = list(get_frames(img))[i].layer.layers[0]
+
+		bench.reset_counters()
+		t = time.time()
+		onion_layers.onion_splice_frames(img, img.active_layer, src_img, 0, nframes*100)
+		t = time.time() - t
+
+		assert len(list(get_frames(img))) == 2000 + nframes
+
+		if (best is None) or (t < best[0]):
+			best = (t, bench.counters.pdb_calls, bench.counters.writes)
+
+		bench.tearDown()
+
+	t, pdb_calls, writes = best
+	print("splice %d frames into 2000: %.3f s, %d PDB calls, %d layer writes" % (
+		nframes, t, pdb_calls, writes))
+
+if __name__ == "__main__":
+	bench_parse()
+	bench_splice()
@@ -3,6 +3,14 @@ import re
 import fcntl
 from contextlib import contextmanager
 import os
+import hashlib
+import json
+import time
+import zlib
+import struct
+import base64
+import uuid
+from multiprocessing.pool import ThreadPool
 
 NEXT_PREV_OPACITY = 25.
 
@@ -40,6 +48,40 @@ def flocked():
 
 # see gimpshelf for persistent storage
 
+# Per-layer state that must survive saving the XCF file is stored in
+# parasites. These are the same values as gimpfu's PARASITE_PERSISTENT and
+# PARASITE_UNDOABLE.
+PARASITE_PERSISTENT = 1
+PARASITE_UNDOABLE = 2
+
+HOLD_PARASITE = "onion-hold"
+
+# When set, neighboring frames only show sub-layers with these names. Sub-layers
+# hidden because of this are marked with CONTEXT_HIDDEN_PARASITE, so that they
+# can be shown again when the frame becomes the current frame.
+CONTEXT_LAYERS_PARASITE = "onion-context-layers"
+CONTEXT_HIDDEN_PARASITE = "onion-context-hidden"
+
+def get_context_layers(img):
+	parasite = img.parasite_find(CONTEXT_LAYERS_PARASITE)
+	if parasite is None:
+		return None
+	else:
+		return set(json.loads(parasite.data))
+
+def is_context_hidden(layer):
+	return layer.parasite_find(CONTEXT_HIDDEN_PARASITE) is not None
+
+# Visibility of a sub-layer set on purpose overrides the context layer filter.
+# The marker is removed, so that the layer isn't shown again when its frame
+# becomes the current frame.
+def set_sub_layer_visible(layer, visible):
+	if layer.visible != visible:
+		layer.visible = visible
+
+	if is_context_hidden(layer):
+		layer.parasite_detach(CONTEXT_HIDDEN_PARASITE)
+
 class Frame(object):
 	TINT_COLORS = {
 		'before': (100, 48, 135),
@@ -53,8 +95,48 @@ class Frame(object):
 		self.opacity = None
 		self.visible = None
 		self.tint = None
-
-	def apply(self, img):
+		# None leaves sub-layers as they are, "all" shows sub-layers
+		# hidden by the context layer filter, a set of names hides
+		# all other sub-layers.
+		self.sub_layers = None
+
+	def get_hold(self):
+		# How many frames this frame is held for. Frames without
+		# the parasite are held for one frame.
+		parasite = self.layer.parasite_find(HOLD_PARASITE)
+		if parasite is None:
+			return 1
+		else:
+			return int(parasite.data)
+
+	def set_hold(self, hold):
+		if hold > 1:
+			self.layer.attach_new_parasite(HOLD_PARASITE,
+					PARASITE_PERSISTENT | PARASITE_UNDOABLE, str(hold))
+		elif self.layer.parasite_find(HOLD_PARASITE) is not None:
+			self.layer.parasite_detach(HOLD_PARASITE)
+
+	def get_content_hash(self):
+		# Hash of everything that affects how the frame looks. Onion
+		# state (frame visibility, opacity and tint layers) is ignored,
+		# so two frames with identical drawings hash the same
+		# regardless of where the onion currently is.
+		h = hashlib.md5()
+		if hasattr(self.layer, 'layers'):
+			for layer in self.layer.layers:
+				if self.TINT_PREFIX in layer.name:
+					continue
+				_hash_layer(h, layer)
+		else:
+			# Visibility and opacity of the frame layer itself are
+			# onion state.
+			h.update(repr(self.layer.mode).encode('utf-8'))
+			_hash_pixels(h, self.layer)
+			if self.layer.mask is not None:
+				_hash_pixels(h, self.layer.mask)
+		return h.hexdigest()
+
+	def apply(self, img, tint=True):
 		# we do it this way to prevent unnecessarily cluttering the undo history.
 		#
 		# AFIAK there is not way to manipulate the history from a plug-in.
@@ -65,8 +147,11 @@ class Frame(object):
 		if (self.visible is not None) and (self.layer.visible != self.visible):
 			self.layer.visible = self.visible
 
+		self._apply_sub_layers()
+
 		# Comment this out if you don't like layer tinting
-		self._apply_tint(img)
+		if tint:
+			self._apply_tint(img)
 
 	@classmethod
 	def clear_tints(cls, img):
@@ -75,6 +160,28 @@ class Frame(object):
 			if tint_layer is not None:
 				tint_layer.visible = False
 
+	def _apply_sub_layers(self):
+		if self.sub_layers is None:
+			return
+
+		if not hasattr(self.layer, 'layers'):
+			return
+
+		for layer in self.layer.layers:
+			if self.TINT_PREFIX in layer.name:
+				continue
+
+			hidden = is_context_hidden(layer)
+			show = (self.sub_layers == "all") or (sanitize_name(layer.name) in self.sub_layers)
+
+			if show and hidden:
+				layer.visible = True
+				layer.parasite_detach(CONTEXT_HIDDEN_PARASITE)
+			elif (not show) and (not hidden) and layer.visible:
+				layer.visible = False
+				layer.attach_new_parasite(CONTEXT_HIDDEN_PARASITE,
+						PARASITE_PERSISTENT | PARASITE_UNDOABLE, "1")
+
 	def _create_tint_layer(self, img, name, color):
 		# Note: tint layer must be RGBA to preseve alpha for underlying layers.
 		# layer mode: addition
@@ -111,6 +218,26 @@ class Frame(object):
 				self._create_tint_layer(img, self.TINT_PREFIX + self.tint,
 						self.TINT_COLORS[self.tint])
 
+def _hash_pixels(h, drawable):
+	w = drawable.width
+	h.update(repr((drawable.offsets, w, drawable.height, drawable.bpp)).encode('utf-8'))
+	rgn = drawable.get_pixel_rgn(0, 0, w, drawable.height, False, False)
+	h.update(rgn[0:w, 0:drawable.height])
+
+def _hash_layer(h, layer):
+	h.update(sanitize_name(layer.name).encode('utf-8'))
+	# Layers hidden by the context layer filter count as visible.
+	visible = layer.visible or is_context_hidden(layer)
+	h.update(repr((bool(visible), layer.opacity, layer.mode)).encode('utf-8'))
+
+	if hasattr(layer, 'layers'):
+		for sub_layer in layer.layers:
+			_hash_layer(h, sub_layer)
+	else:
+		_hash_pixels(h, layer)
+		if layer.mask is not None:
+			_hash_pixels(h, layer.mask)
+
 def get_frames(img):
 	for layer in img.layers:
 		if layer.name.startswith('['):
@@ -119,6 +246,17 @@ def get_frames(img):
 		yield Frame(layer)
 
 class NumberedName(object):
+	__slots__ = ('name', 'num', 'width', 'is_mask')
+
+	# Name, trailing digits and, if layer mask is active when a function
+	# is invoked, " mask" that is appended to the active layer name.
+	NAME_RE = re.compile(r'(.*?)(\d*)( mask)?\Z', re.DOTALL)
+
+	# Layer names are parsed over and over again, so results are cached.
+	# Cached values are tuples, since callers modify returned objects.
+	CACHE_SIZE = 16384
+	_cache = {}
+
 	def __init__(self, name, num=None, width=None, is_mask=False):
 		self.name = name
 		self.num = num
@@ -127,23 +265,21 @@ class NumberedName(object):
 
 	@classmethod
 	def from_layer_name(cls, name):
-		# if layer mask is active when a function is invoked,
-		# the active layer name has " mask" appended.
-		name_nomask = re.sub(r' mask$', '', name)
+		parsed = cls._cache.get(name)
 
-		is_mask = (name_nomask != name)
+		if parsed is None:
+			name_nonum, digits, mask = cls.NAME_RE.match(name).groups()
 
-		g = re.search(r'(\d+)$', name_nomask)
-		if g:
-			num = int(g.group(1))
-			width = len(g.group(1))
-		else:
-			num = None
-			width = None
+			if digits:
+				parsed = (name_nonum, int(digits), len(digits), mask is not None)
+			else:
+				parsed = (name_nonum, None, None, mask is not None)
 
-		name_nonum = re.sub(r'\d+$', '', name_nomask)
+			if len(cls._cache) >= cls.CACHE_SIZE:
+				cls._cache.clear()
+			cls._cache[name] = parsed
 
-		return cls(name_nonum, num, width, is_mask)
+		return cls(*parsed)
 
 	def get_new_frame_increment(self):
 		if self.width >= 4:
@@ -227,22 +363,439 @@ def get_middle_number(a, b):
 def sanitize_name(name):
 	return NumberedName.from_layer_name(name).name
 
-def show_all(img, act_layer):
+# Returns (start, end) index pairs of runs of two or more equal consecutive
+# values. end is inclusive.
+def find_identical_runs(hashes):
+	runs = []
+
+	start = 0
+	for i in range(1, len(hashes) + 1):
+		if (i == len(hashes)) or (hashes[i] != hashes[start]):
+			if i - start > 1:
+				runs.append((start, i - 1))
+			start = i
+
+	return runs
+
+# Returns k numbers evenly spread between a and b (exclusive), in
+# increasing order. If b is None, numbers are spaced by increment after a.
+def spread_numbers(a, b, k, increment=1):
+	if b is None:
+		return [ a + increment*(n + 1) for n in range(k) ]
+
+	if b - a - 1 < k:
+		raise ValueError
+
+	return [ a + ((b - a)*(n + 1)) // (k + 1) for n in range(k) ]
+
+# Changes the number of a frame and all numbered layers inside it.
+#
+# When layer is a copy, pass the original as template. GIMP appends " copy" or
+# "#1" to names of copies, so names need to be taken from the original.
+def set_frame_number(layer, num, template=None, width=None):
+	if template is None:
+		template = layer
+
+	nn = NumberedName.from_layer_name(template.name)
+	if nn.num is not None:
+		nn.num = num
+		if width is not None:
+			nn.width = width
+		layer.name = nn.to_string()
+
+	if hasattr(layer, 'layers'):
+		for sub_layer, sub_template in zip(layer.layers, template.layers):
+			set_frame_number(sub_layer, num, sub_template, width)
+
+# A copy of a frame is a new frame of its own, so it should only contain the
+# drawing: tint layers are removed and sub-layers hidden by the context layer
+# filter are shown again. Pass context_hidden=False if the frame comes from an
+# image without the filter, to skip looking for hidden sub-layers.
+def clean_frame_copy(img, layer, context_hidden=True):
+	if not hasattr(layer, 'layers'):
+		return
+
+	for sub_layer in layer.layers:
+		if Frame.TINT_PREFIX in sub_layer.name:
+			pdb.gimp_image_remove_layer(img, sub_layer)
+		elif context_hidden and is_context_hidden(sub_layer):
+			sub_layer.visible = True
+			sub_layer.parasite_detach(CONTEXT_HIDDEN_PARASITE)
+
+# Returns the number of the first numbered frame above stack index n, or None
+# if there is none.
+def get_next_frame_number(frames, n):
+	for frame in reversed(frames[:n]):
+		num = NumberedName.from_layer_name(frame.layer.name).num
+		if num is not None:
+			return num
+
+	return None
+
+# Returns the number of the first numbered frame below stack index n, or None
+# if there is none.
+def get_prev_frame_number(frames, n):
+	for frame in frames[n + 1:]:
+		num = NumberedName.from_layer_name(frame.layer.name).num
+		if num is not None:
+			return num
+
+	return None
+
+# Changes numbers of several frames. moves is a list of (layer, old number,
+# new number). Both old and new numbers must be in the same order as the
+# frames.
+#
+# GIMP renames a layer if its new name is already taken, so frames are
+# renamed in an order where a new name is never taken by a frame that
+# wasn't renamed yet: frames that move up from the top down, then frames
+# that move down from the bottom up.
+def move_frame_numbers(moves):
+	up = sorted([ move for move in moves if move[2] > move[1] ], key=lambda move: -move[1])
+	down = sorted([ move for move in moves if move[2] < move[1] ], key=lambda move: move[1])
+
+	for layer, old, new in up + down:
+		set_frame_number(layer, new)
+
+# Paging keeps only frames near the current one in GIMP's memory. Sub-layers
+# of frames further than "distance" frames away are written to a page file and
+# removed, leaving the empty frame group as a placeholder. They are read back
+# when an onion step comes close, including "prefetch" frames ahead in the
+# direction of travel.
+#
+# Sub-layers keep their pixels, layer mask and the properties shown in the
+# Layers dialog: name, visibility, opacity, mode, offsets, locks, link, color
+# tag, mask state and parasites. Frames that contain nested groups are never
+# paged out.
+#
+# Page files hold the only copy of paged out drawings, so they are kept with
+# user data and not in the cache folder. They are named by a hash of their
+# content, so paging out a frame that didn't change reuses its file. Files are
+# never removed by the plug-in: other images, such as older saved copies of an
+# XCF or images made with Image -> Duplicate, can refer to the same files.
+#
+# Memory is only freed once the removal of layers drops out of the undo
+# history.
+
+PAGING_PARASITE = "onion-paging"
+PAGED_PARASITE = "onion-paged"
+
+DATA_DIR = os.environ.get('XDG_DATA_HOME', os.path.join(os.environ['HOME'], '.local', 'share'))
+PAGE_DIR = os.path.join(DATA_DIR, 'gimp-plugin-onion-layers-pages')
+PAGE_PREFETCH = 2
+
+def write_page(path, infos, blobs):
+	header = json.dumps(infos).encode('utf-8')
+
+	tmp_path = "%s.%d.tmp" % (path, os.getpid())
+	with open(tmp_path, "wb") as f:
+		f.write(struct.pack('<I', len(header)))
+		f.write(header)
+		for blob in blobs:
+			data = zlib.compress(blob)
+			f.write(struct.pack('<I', len(data)))
+			f.write(data)
+	os.rename(tmp_path, path)
+
+def read_page(path):
+	def read_chunk(f):
+		size, = struct.unpack('<I', f.read(4))
+		return f.read(size)
+
+	with open(path, "rb") as f:
+		infos = json.loads(read_chunk(f).decode('utf-8'))
+
+		blobs = []
+		for info in infos:
+			blobs.append(zlib.decompress(read_chunk(f)))
+			if info['mask']:
+				blobs.append(zlib.decompress(read_chunk(f)))
+
+	return infos, blobs
+
+def _to_bytes(s):
+	# Parasite data is a str, which is already bytes on Python 2.
+	if isinstance(s, bytes):
+		return s
+	else:
+		return s.encode('utf-8')
+
+def get_page_name(infos, blobs):
+	h = hashlib.md5(json.dumps(infos, sort_keys=True).encode('utf-8'))
+	for blob in blobs:
+		h.update(struct.pack('<I', len(blob)))
+		h.update(blob)
+	return h.hexdigest() + '.page'
+
+def _read_pixels(drawable):
+	rgn = drawable.get_pixel_rgn(0, 0, drawable.width, drawable.height, False, False)
+	return rgn[0:drawable.width, 0:drawable.height]
+
+def _write_pixels(drawable, data):
+	rgn = drawable.get_pixel_rgn(0, 0, drawable.width, drawable.height, True, False)
+	rgn[0:drawable.width, 0:drawable.height] = data
+	drawable.flush()
+	drawable.update(0, 0, drawable.width, drawable.height)
+
+class Pager(object):
+	def __init__(self, key, distance, prefetch=PAGE_PREFETCH):
+		self.key = key
+		self.distance = max(distance, Context.SIZE + prefetch)
+		self.prefetch = prefetch
+
+	@classmethod
+	def from_image(cls, img):
+		parasite = img.parasite_find(PAGING_PARASITE)
+		if parasite is None:
+			return None
+
+		d = json.loads(parasite.data)
+		return cls(_to_str(d['key']), d['distance'], d['prefetch'])
+
+	def save(self, img):
+		img.attach_new_parasite(PAGING_PARASITE, PARASITE_PERSISTENT, json.dumps({
+			'key': self.key,
+			'distance': self.distance,
+			'prefetch': self.prefetch,
+		}))
+
+	def get_dir(self):
+		return os.path.join(PAGE_DIR, self.key)
+
+	def can_page_out(self, frame):
+		if not hasattr(frame.layer, 'layers'):
+			return False
+
+		if frame.layer.parasite_find(PAGED_PARASITE) is not None:
+			return False
+
+		for layer in frame.layer.layers:
+			if hasattr(layer, 'layers'):
+				return False
+
+		return True
+
+	def page_out(self, img, frame):
+		if not self.can_page_out(frame):
+			return
+
+		infos = []
+		blobs = []
+		layers = []
+		for n, layer in enumerate(frame.layer.layers):
+			# Tint layers are moved around by onion steps, so leave
+			# them where they are.
+			if frame.TINT_PREFIX in layer.name:
+				continue
+
+			info = {
+				'name': layer.name,
+				'position': n,
+				'type': layer.type,
+				'width': layer.width,
+				'height': layer.height,
+				'offsets': layer.offsets,
+				'visible': bool(layer.visible),
+				'opacity': layer.opacity,
+				'mode': layer.mode,
+				'lock_alpha': bool(layer.lock_alpha),
+				'lock_content': bool(pdb.gimp_item_get_lock_content(layer)),
+				'lock_position': bool(pdb.gimp_item_get_lock_position(layer)),
+				'linked': bool(layer.linked),
+				'color_tag': pdb.gimp_item_get_color_tag(layer),
+				'parasites': self._get_parasites(layer),
+				'mask': layer.mask is not None,
+			}
+
+			blobs.append(_read_pixels(layer))
+			if layer.mask is not None:
+				info['apply_mask'] = bool(layer.apply_mask)
+				info['show_mask'] = bool(layer.show_mask)
+				info['edit_mask'] = bool(layer.edit_mask)
+				blobs.append(_read_pixels(layer.mask))
+
+			infos.append(info)
+			layers.append(layer)
+
+		if not layers:
+			return
+
+		if not os.path.isdir(self.get_dir()):
+			os.makedirs(self.get_dir())
+
+		name = get_page_name(infos, blobs)
+		path = os.path.join(self.get_dir(), name)
+		if not os.path.exists(path):
+			write_page(path, infos, blobs)
+
+		for layer in layers:
+			pdb.gimp_image_remove_layer(img, layer)
+
+		frame.layer.attach_new_parasite(PAGED_PARASITE,
+				PARASITE_PERSISTENT | PARASITE_UNDOABLE, name)
+
+	def page_in(self, img, frame):
+		if not hasattr(frame.layer, 'layers'):
+			return
+
+		parasite = frame.layer.parasite_find(PAGED_PARASITE)
+		if parasite is None:
+			return
+
+		try:
+			infos, blobs = read_page(os.path.join(self.get_dir(), parasite.data))
+		except (IOError, OSError, ValueError, struct.error, zlib.error):
+			pdb.gimp_message("Can't read paged out layers of frame %s" % (frame.layer.name,))
+			return
+
+		# The frame might have been renumbered since it was paged out.
+		frame_name = NumberedName.from_layer_name(frame.layer.name)
+
+		blobs = iter(blobs)
+		for info in infos:
+			name = NumberedName.from_layer_name(_to_str(info['name']))
+			if (name.num is not None) and (frame_name.num is not None):
+				name.num = frame_name.num
+				name.width = frame_name.width
+
+			layer = pdb.gimp_layer_new(img, info['width'], info['height'], info['type'],
+					name.to_string(), info['opacity'], info['mode'])
+			pdb.gimp_image_insert_layer(img, layer, frame.layer, info['position'])
+			layer.set_offsets(*info['offsets'])
+			_write_pixels(layer, next(blobs))
+
+			if info['mask']:
+				# 0 is a white (full opacity) mask
+				mask = layer.create_mask(0)
+				layer.add_mask(mask)
+				_write_pixels(mask, next(blobs))
+
+				layer.apply_mask = info['apply_mask']
+				layer.show_mask = info['show_mask']
+				layer.edit_mask = info['edit_mask']
+
+			layer.visible = info['visible']
+			layer.lock_alpha = info['lock_alpha']
+			layer.linked = info['linked']
+			pdb.gimp_item_set_color_tag(layer, info['color_tag'])
+
+			# Locks go last, since they prevent setting offsets and
+			# pixels.
+			pdb.gimp_item_set_lock_content(layer, info['lock_content'])
+			pdb.gimp_item_set_lock_position(layer, info['lock_position'])
+
+			self._set_parasites(layer, info['parasites'])
+
+		frame.layer.parasite_detach(PAGED_PARASITE)
+
+	def _get_parasites(self, layer):
+		parasites = []
+		for name in layer.parasite_list():
+			parasite = layer.parasite_find(name)
+			parasites.append((name, parasite.flags,
+				base64.b64encode(_to_bytes(parasite.data)).decode('ascii')))
+		return parasites
+
+	def _set_parasites(self, layer, parasites):
+		for name, flags, data in parasites:
+			layer.attach_new_parasite(_to_str(name), flags, base64.b64decode(data))
+
+	def update(self, img, frames, i, inc):
+		N = len(frames)
+
+		# Current frame, its context and frames ahead must be resident.
+		near = set((i + c) % N for c in range(-Context.SIZE, Context.SIZE + 1))
+		for k in range(1, self.prefetch + 1):
+			if inc >= 0:
+				near.add((i + k) % N)
+			if inc <= 0:
+				near.add((i - k) % N)
+
+		for k in near:
+			self.page_in(img, frames[k])
+
+		# Frames that just went out of range are paged out.
+		if N > 2*self.distance + 1:
+			for k in ((i - self.distance - 1) % N, (i + self.distance + 1) % N):
+				self.page_out(img, frames[k])
+
+	def page_out_far(self, img, frames, i):
+		N = len(frames)
+		for k, frame in enumerate(frames):
+			d = min((k - i) % N, (i - k) % N)
+			if d > self.distance:
+				self.page_out(img, frame)
+
+# Reads all paged out frames back into memory. Call this before working with
+# sub-layers of all frames.
+def page_in_all(img):
+	pager = Pager.from_image(img)
+	if pager is None:
+		return
+
 	img.undo_group_start()
 
 	for frame in get_frames(img):
+		pager.page_in(img, frame)
+
+	img.undo_group_end()
+
+# Pages frames far from frame i out again after page_in_all. With i=None, the
+# current frame is found from frame visibility.
+def page_out_far_frames(img, i=None):
+	pager = Pager.from_image(img)
+	if pager is None:
+		return
+
+	frames = list(get_frames(img))
+	if not frames:
+		return
+
+	if i is None:
+		i = Context.from_frames(frames).current_index
+
+	img.undo_group_start()
+
+	pager.page_out_far(img, frames, i)
+
+	img.undo_group_end()
+
+def show_all(img, act_layer):
+	frames = list(get_frames(img))
+
+	# If no frames were found, do nothing.
+	if not frames:
+		return
+
+	# All frames are at full opacity afterwards, so the current frame
+	# has to be found before.
+	i = Context.from_frames(frames).current_index
+
+	page_in_all(img)
+
+	img.undo_group_start()
+
+	for frame in frames:
 		frame.opacity = 100.
 		frame.visible = True
 		frame.tint = "clean"
+		frame.sub_layers = "all"
 		frame.apply(img)
 
+	forget_current_preset(img)
+
 	img.undo_group_end()
 
+	page_out_far_frames(img, i)
+
 def onion(*args, **kwargs):
 	with flocked():
 		return onion_unsafe(*args, **kwargs)
 
-def onion_unsafe(img, act_layer, inc, contextobj=None, dryrun=False, do_tint=False):
+# With fast=True, only visibility and opacity of frames are changed. Tint
+# layers are hidden and the active layer is left as it is. Call again with
+# fast=False and inc=0 to bring these up to date.
+def onion_unsafe(img, act_layer, inc, contextobj=None, dryrun=False, do_tint=False, fast=False):
 
 	# Frames are either top-level layers or layer groups.
 	frames = list(get_frames(img))
@@ -263,6 +816,11 @@ def onion_unsafe(img, act_layer, inc, contextobj=None, dryrun=False, do_tint=Fal
 		i = (i + inc) % N
 		contextobj.current_index = i
 
+		if fast:
+			context_layers = None
+		else:
+			context_layers = get_context_layers(img)
+
 		# Change visibility of frames.
 		for frame in frames:
 			frame.visible = False
@@ -279,6 +837,7 @@ def onion_unsafe(img, act_layer, inc, contextobj=None, dryrun=False, do_tint=Fal
 			if (context[j] is not None) and (k != i) and not frames[k].visible:
 				frames[k].opacity = context[j]
 				frames[k].visible = True
+				frames[k].sub_layers = context_layers
 
 				if do_tint:
 					if c < 0:
@@ -289,17 +848,28 @@ def onion_unsafe(img, act_layer, inc, contextobj=None, dryrun=False, do_tint=Fal
 		frames[i].opacity = 100.
 		frames[i].visible = True
 		frames[i].tint = None
+		if context_layers is not None:
+			frames[i].sub_layers = "all"
 
 		img.undo_group_start()
 
+		# Paging is slow, so it waits for the full update after fast
+		# steps. Until then, far frames might show up empty.
+		if not fast:
+			pager = Pager.from_image(img)
+			if pager is not None:
+				pager.update(img, frames, i, inc)
+
 		Frame.clear_tints(img)
 		for frame in frames:
-			frame.apply(img)
+			frame.apply(img, tint=not fast)
 
 		img.undo_group_end()
 
 		# Use some heuristic to change the active layer as well.
-		if hasattr(frames[i].layer, 'layers'):
+		if fast:
+			pass
+		elif hasattr(frames[i].layer, 'layers'):
 			n = sanitize_name(act_layer.name)
 
 			for layer in frames[i].layer.layers:
@@ -313,6 +883,97 @@ def onion_unsafe(img, act_layer, inc, contextobj=None, dryrun=False, do_tint=Fal
 
 	return contextobj
 
+# When frames take long to update, or keys are pressed faster than frames
+# can be updated, the adaptive functions only flip frame visibility. Once
+# no key has been pressed for QUIET_TIME, tinting and the active layer are
+# updated as well.
+#
+# Each function call runs in a separate process, so timing of recent steps
+# is kept in a file, like the lock.
+
+LATENCY_BUDGET = 0.15
+QUIET_TIME = 0.4
+
+LATENCY_FILE = os.path.join(LOCK_DIR, 'gimp-plugin-onion-layers-latency')
+
+class LatencyBudget(object):
+	# Weight of the most recent full step in the running average.
+	ALPHA = 0.5
+
+	def __init__(self, last_pressed=None, full_duration=0., seq=0):
+		self.last_pressed = last_pressed
+		self.full_duration = full_duration
+		self.seq = seq
+
+	@classmethod
+	def load(cls, path=LATENCY_FILE):
+		try:
+			with open(path) as f:
+				d = json.load(f)
+			return cls(d['last_pressed'], d['full_duration'], d['seq'])
+		except (IOError, OSError, ValueError, KeyError):
+			return cls()
+
+	def save(self, path=LATENCY_FILE):
+		with open(path, "w") as f:
+			json.dump({
+				'last_pressed': self.last_pressed,
+				'full_duration': self.full_duration,
+				'seq': self.seq,
+			}, f)
+
+	def is_over_budget(self, pressed):
+		if self.full_duration > LATENCY_BUDGET:
+			return True
+
+		# Keys are pressed faster than we can do full steps.
+		if (self.last_pressed is not None) and (pressed - self.last_pressed < self.full_duration):
+			return True
+
+		return False
+
+	def record_step(self, pressed, fast, duration):
+		self.last_pressed = pressed
+		self.seq += 1
+		if not fast:
+			self.record_full(duration)
+
+	def record_full(self, duration):
+		self.full_duration = self.ALPHA*duration + (1. - self.ALPHA)*self.full_duration
+
+def onion_adaptive(img, act_layer, inc, do_tint=False):
+	pressed = time.time()
+
+	with flocked():
+		budget = LatencyBudget.load()
+		fast = budget.is_over_budget(pressed)
+
+		t = time.time()
+		onion_unsafe(img, act_layer, inc, do_tint=do_tint, fast=fast)
+		budget.record_step(pressed, fast, time.time() - t)
+		budget.save()
+
+		seq = budget.seq
+
+	if not fast:
+		return
+
+	gimp.displays_flush()
+	time.sleep(QUIET_TIME)
+
+	with flocked():
+		budget = LatencyBudget.load()
+
+		# Another key was pressed in the mean time. Leave the full
+		# update to that one.
+		if budget.seq != seq:
+			return
+
+		t = time.time()
+		onion_unsafe(img, act_layer, 0, do_tint=do_tint)
+		budget.record_full(time.time() - t)
+		budget.save()
+
 def onion_up(img, layer):
 	onion(img, layer, -1, [100.])
 
@@ -337,6 +998,12 @@ def onion_up_ctx_auto_tint(img, layer):
 def onion_down_ctx_auto_tint(img, layer):
 	onion(img, layer, 1, None, do_tint=True)
 
+def onion_up_ctx_auto_tint_adaptive(img, layer):
+	onion_adaptive(img, layer, -1, do_tint=True)
+
+def onion_down_ctx_auto_tint_adaptive(img, layer):
+	onion_adaptive(img, layer, 1, do_tint=True)
+
 def cycle_context(img, layer, do_tint=False):
 
 	contextobj = onion(img, layer, 0, dryrun=True)
@@ -358,7 +1025,71 @@ def onion_cycle_context(img, layer):
 def onion_cycle_context_tint(img, layer):
 	cycle_context(img, layer, do_tint=True)
 
+def onion_set_context_layers(img, act_layer, names):
+	names = [ sanitize_name(name.strip()) for name in names.split(',') ]
+	names = [ name for name in names if name ]
+
+	img.undo_group_start()
+
+	if names:
+		img.attach_new_parasite(CONTEXT_LAYERS_PARASITE, PARASITE_PERSISTENT | PARASITE_UNDOABLE,
+				json.dumps(names))
+
+		onion(img, act_layer, 0)
+	else:
+		# Show everything we've hidden in any frame.
+		if img.parasite_find(CONTEXT_LAYERS_PARASITE) is not None:
+			img.parasite_detach(CONTEXT_LAYERS_PARASITE)
+
+		page_in_all(img)
+
+		for frame in get_frames(img):
+			frame.sub_layers = "all"
+			frame.apply(img)
+
+		page_out_far_frames(img)
+
+	forget_current_preset(img)
+
+	img.undo_group_end()
+
+def onion_enable_paging(img, act_layer, distance):
+	frames = list(get_frames(img))
+
+	# If no frames were found, do nothing.
+	N = len(frames)
+	if N < 1:
+		return
+
+	pager = Pager.from_image(img)
+	if pager is None:
+		pager = Pager(uuid.uuid4().hex, distance)
+	else:
+		pager = Pager(pager.key, distance, pager.prefetch)
+
+	contextobj = onion(img, act_layer, 0, dryrun=True)
+
+	img.undo_group_start()
+
+	pager.save(img)
+	pager.page_out_far(img, frames, contextobj.current_index)
+
+	img.undo_group_end()
+
+def onion_disable_paging(img, act_layer):
+	pager = Pager.from_image(img)
+	if pager is None:
+		return
+
+	page_in_all(img)
+
+	img.undo_group_start()
+	img.parasite_detach(PAGING_PARASITE)
+	img.undo_group_end()
+
 def onion_copy_layer(img, act_layer):
+	page_in_all(img)
+
 	frames = list(get_frames(img))
 
 	# If no frames were found, do nothing.
@@ -394,12 +1125,13 @@ def onion_copy_layer(img, act_layer):
 			if sanitize_name(layer.name) == act_name:
 				# This frame already has a copy. Just copy over
 				# visibility and opacity.
-				layer.visible = act_layer.visible
+				set_sub_layer_visible(layer, act_layer.visible)
 				layer.opacity = act_layer.opacity
 				break
 		else:
 			# This frame doesn't have a copy. Make one.
 			layer = act_layer.copy()
+			set_sub_layer_visible(layer, act_layer.visible)
 
 			# Copy over frame number
 			g = re.search(r'(\d+)$', frame.layer.name)
@@ -426,18 +1158,23 @@ def onion_copy_layer(img, act_layer):
 	# Without this, the active layer ends up the last copied layer.
 	img.active_layer = act_layer
 
+	forget_current_preset(img)
+
 	img.undo_group_end()
 
+	page_out_far_frames(img)
+
 def renumber_frames(img):
 
 	frames = list(get_frames(img))
 
 	def update_layer_name(layer, num, temp):
 		nn = NumberedName.from_layer_name(layer.name)
-		if nn.width < 4:
-			nn.width = 4
 
 		if nn.num is not None:
+			if nn.width < 4:
+				nn.width = 4
+
 			if temp:
 				nn.name = "temp-" + nn.name
 			else:
@@ -462,6 +1199,33 @@ def renumber_frames(img):
 	do_renumber(temp=True)
 	do_renumber(temp=False)
 
+# Inserts a new frame at position in the stack. If template is a layer group,
+# the new frame gets a blank layer for each numbered layer in the template.
+def add_blank_frame(img, template, new_frame_name, position):
+	if not hasattr(template, 'layers'):
+		new_frame = pdb.gimp_layer_new(img, img.width, img.height, 1,
+				new_frame_name.to_string(), template.opacity, 0)
+		pdb.gimp_image_insert_layer(img, new_frame, None, position)
+		return new_frame
+
+	new_frame = pdb.gimp_layer_group_new(img)
+	new_frame.name = new_frame_name.to_string()
+	pdb.gimp_image_insert_layer(img, new_frame, None, position)
+
+	for n, layer in enumerate(template.layers):
+		name = NumberedName.from_layer_name(layer.name)
+
+		if name.num is None:
+			continue
+		name.num = new_frame_name.num
+
+		new_layer = pdb.gimp_layer_new(img, img.width, img.height, 1,
+				name.to_string(), layer.opacity, 0)
+
+		pdb.gimp_image_insert_layer(img, new_layer, new_frame, n)
+
+	return new_frame
+
 def onion_add_frame(img, act_layer):
 	frames = list(get_frames(img))
 
@@ -517,21 +1281,7 @@ def onion_add_frame(img, act_layer):
 	# as currently visible.
 	act_frame.visible = False
 
-	new_frame = pdb.gimp_layer_group_new(img)
-	new_frame.name = new_frame_name.to_string()
-	pdb.gimp_image_insert_layer(img, new_frame, None, n)
-
-	for n, layer in enumerate(act_frame.layers):
-		name = NumberedName.from_layer_name(layer.name)
-
-		if name.num is None:
-			continue
-		name.num = new_frame_name.num
-
-		new_layer = pdb.gimp_layer_new(img, img.width, img.height, 1,
-				name.to_string(), layer.opacity, 0)
-
-		pdb.gimp_image_insert_layer(img, new_layer, new_frame, n)
+	add_blank_frame(img, act_frame, new_frame_name, n)
 
 	# quick dirty check if tinting was used
 	do_tint = (pdb.gimp_image_get_layer_by_name(img, "onion-tint-after") is not None)
@@ -621,42 +1371,931 @@ def onion_convert_to_groups(img, act_layer):
 
 	img.undo_group_end()
 
-def onion_renumber_frames(img, act_layer):
+# Sub-layer visibility and opacity presets are stored in an image parasite
+# as JSON: { "presets": { preset: { name: [ visible, opacity ] } },
+# "current": preset }. Names are sanitized sub-layer names.
+PRESETS_PARASITE = "onion-presets"
+
+def _to_str(s):
+	# json returns unicode strings on Python 2, while GIMP layer names
+	# are UTF-8 encoded str.
+	if isinstance(s, str):
+		return s
+	else:
+		return s.encode('utf-8')
+
+class SubLayerPresets(object):
+	def __init__(self, presets=None, current=None):
+		if presets is None:
+			presets = {}
+		self.presets = presets
+		self.current = current
+
+	@classmethod
+	def from_image(cls, img):
+		parasite = img.parasite_find(PRESETS_PARASITE)
+		if parasite is None:
+			return cls()
+
+		d = json.loads(parasite.data)
+
+		presets = {}
+		for preset, states in d['presets'].items():
+			presets[_to_str(preset)] = dict(
+					(_to_str(name), tuple(state)) for name, state in states.items())
+
+		current = d['current']
+		if current is not None:
+			current = _to_str(current)
+
+		return cls(presets, current)
+
+	def save(self, img):
+		img.attach_new_parasite(PRESETS_PARASITE, PARASITE_PERSISTENT | PARASITE_UNDOABLE, json.dumps({
+			'presets': self.presets,
+			'current': self.current,
+		}))
+
+	def get_changes(self, preset):
+		# If we know which preset was applied last, only names that
+		# differ between the two presets need to be touched. Applying
+		# the same preset again touches all its names, in case layers
+		# were changed by hand in the mean time.
+		states = self.presets[preset]
+
+		if (self.current != preset) and (self.current in self.presets):
+			old_states = self.presets[self.current]
+		else:
+			old_states = {}
+
+		return dict((name, state) for name, state in states.items()
+				if old_states.get(name) != state)
+
+# Call this after changing sub-layers in any other way than applying a preset,
+# since layers no longer match the last applied preset.
+def forget_current_preset(img):
+	presets = SubLayerPresets.from_image(img)
+	if presets.current is not None:
+		presets.current = None
+		presets.save(img)
+
+# Sets visibility and opacity of sub-layers in all frames. states maps
+# sanitized sub-layer names to (visible, opacity). None leaves that
+# property as it is. Only layers that change are written to.
+def apply_sub_layer_states(img, states):
+	if not states:
+		return
+
+	for frame in get_frames(img):
+		if not hasattr(frame.layer, 'layers'):
+			continue
+
+		for layer in frame.layer.layers:
+			if frame.TINT_PREFIX in layer.name:
+				continue
+
+			state = states.get(sanitize_name(layer.name))
+			if state is None:
+				continue
+
+			visible, opacity = state
+
+			if visible is not None:
+				set_sub_layer_visible(layer, visible)
+
+			if (opacity is not None) and (layer.opacity != opacity):
+				layer.opacity = opacity
+
+def onion_set_sub_layer(img, act_layer, name, visible, opacity):
+	page_in_all(img)
+
 	img.undo_group_start()
 
-	renumber_frames(img)
+	apply_sub_layer_states(img, { sanitize_name(name): (bool(visible), float(opacity)) })
+	forget_current_preset(img)
 
 	img.undo_group_end()
 
-def start():
-	register(
-		"python_fu_onion_up",
-		"Onion up",
-		"Move one onion layer up",
-		"Tomaz Solc",
-		"Open source (BSD 3-clause license)",
-		"2022",
-		"<Image>/Filters/Animation/Onion layers/up",
-		"*",
-		[],
-		[],
-		onion_up)
+	page_out_far_frames(img)
 
-	register(
-		"python_fu_onion_down",
-		"Onion down",
-		"Move one onion layer down",
-		"Tomaz Solc",
-		"GPLv3+",
-		"2022",
-		"<Image>/Filters/Animation/Onion layers/down",
-		"*",
-		[],
-		[],
-		onion_down)
+def onion_save_preset(img, act_layer, preset):
+	# Get the top level layer (frame) from the currently active layer
+	act_frame = act_layer
+	while act_frame.parent is not None:
+		act_frame = act_frame.parent
 
-	register(
-		"python_fu_onion_up_ctx",
+	# This only works if frames are layer groups
+	if not hasattr(act_frame, 'layers'):
+		return
+
+	states = {}
+	for layer in act_frame.layers:
+		if Frame.TINT_PREFIX in layer.name:
+			continue
+		states[sanitize_name(layer.name)] = (bool(layer.visible), layer.opacity)
+
+	presets = SubLayerPresets.from_image(img)
+	presets.presets[preset] = states
+	# Other frames might not match the active one, so don't assume that
+	# this preset is now applied.
+	presets.current = None
+	presets.save(img)
+
+def onion_apply_preset(img, act_layer, preset):
+	presets = SubLayerPresets.from_image(img)
+
+	if preset not in presets.presets:
+		pdb.gimp_message("No preset named %r. Save it first." % (preset,))
+		return
+
+	page_in_all(img)
+
+	img.undo_group_start()
+
+	apply_sub_layer_states(img, presets.get_changes(preset))
+
+	presets.current = preset
+	presets.save(img)
+
+	img.undo_group_end()
+
+	page_out_far_frames(img)
+
+# Returns indices of the strictly increasing subsequence of values with the
+# largest total weight. values must be a permutation of range(len(values)).
+def get_heaviest_increasing_subsequence(values, weights):
+	N = len(values)
+
+	# Fenwick tree over values, holding (total weight, index) of the best
+	# subsequence ending with a value in the range.
+	tree = [ (0, -1) ] * (N + 1)
+	prev = [ -1 ] * N
+	best = (0, -1)
+
+	for i, v in enumerate(values):
+		q = (0, -1)
+		j = v
+		while j > 0:
+			q = max(q, tree[j])
+			j -= j & -j
+
+		prev[i] = q[1]
+		entry = (q[0] + weights[i], i)
+		best = max(best, entry)
+
+		j = v + 1
+		while j <= N:
+			tree[j] = max(tree[j], entry)
+			j += j & -j
+
+	result = []
+	i = best[1]
+	while i != -1:
+		result.append(i)
+		i = prev[i]
+
+	result.reverse()
+	return result
+
+# Plans the moves that sort a stack of items. keys[i] is the sort key of the
+# item at position i, or None if the item must stay where it is. Returns a list
+# of (i, position) moves, where i is the original position of the item.
+#
+# Items in the longest already sorted subsequence stay in place, so a nearly
+# sorted stack only needs a few moves.
+def plan_sort_moves(keys):
+	N = len(keys)
+
+	slots = [ i for i in range(N) if keys[i] is not None ]
+	ordered = sorted(slots, key=lambda i: keys[i])
+
+	final = list(range(N))
+	for slot, i in zip(slots, ordered):
+		final[slot] = i
+
+	rank = [ 0 ] * N
+	for n, i in enumerate(final):
+		rank[i] = n
+
+	# Items that must stay are already in order relative to each other.
+	# Weighting them heavily makes sure they are never moved.
+	weights = [ 1 if key is not None else N + 1 for key in keys ]
+
+	keep = set(get_heaviest_increasing_subsequence(rank, weights))
+
+	# Move the other items in order of their final position, each one
+	# right after the item that precedes it in the final order.
+	stack = list(range(N))
+	moves = []
+	for n, i in enumerate(final):
+		if i in keep:
+			continue
+
+		stack.remove(i)
+		if n == 0:
+			position = 0
+		else:
+			position = stack.index(final[n-1]) + 1
+		stack.insert(position, i)
+
+		moves.append((i, position))
+
+	return moves
+
+# Memory and compositing cost report. The report is a JSON document, so
+# that it can be compared between versions of a file. Bump
+# REPORT_FORMAT when the structure changes.
+
+REPORT_FORMAT = 1
+
+# Full canvas layers with less than this fraction of non-transparent pixels
+# are reported as mostly empty.
+EMPTY_COVERAGE = 0.1
+
+def get_coverage(layer):
+	# Fraction of pixels that are not fully transparent.
+	if not layer.has_alpha:
+		return 1.
+
+	# channel 4 is alpha
+	mean, std_dev, median, pixels, count, percentile = \
+			pdb.gimp_drawable_histogram(layer, 4, 1./255, 1.)
+	if pixels == 0:
+		return 0.
+
+	return float(count) / pixels
+
+def get_layer_cost(img, layer):
+	cost = {
+		'name': layer.name,
+		'sub_layer': sanitize_name(layer.name),
+		'width': layer.width,
+		'height': layer.height,
+		'bytes': layer.width * layer.height * layer.bpp,
+	}
+
+	if hasattr(layer, 'layers'):
+		# Groups hold a buffer with their projection.
+		cost['layers'] = [ get_layer_cost(img, sub_layer) for sub_layer in layer.layers ]
+		for sub_cost in cost['layers']:
+			cost['bytes'] += sub_cost['bytes']
+	else:
+		if layer.mask is not None:
+			cost['bytes'] += layer.mask.width * layer.mask.height * layer.mask.bpp
+
+		full_canvas = (layer.offsets == (0, 0)) and \
+				(layer.width == img.width) and (layer.height == img.height)
+		if full_canvas:
+			cost['coverage'] = get_coverage(layer)
+
+	return cost
+
+def _walk_costs(costs):
+	for cost in costs:
+		yield cost
+		for sub_cost in _walk_costs(cost.get('layers', [])):
+			yield sub_cost
+
+def get_compositing_cost(layers):
+	# Number of layers and pixels that GIMP needs to composite to
+	# show the image.
+	n = 0
+	pixels = 0
+
+	for layer in layers:
+		if not layer.visible:
+			continue
+
+		n += 1
+		pixels += layer.width * layer.height
+
+		if hasattr(layer, 'layers'):
+			sub_n, sub_pixels = get_compositing_cost(layer.layers)
+			n += sub_n
+			pixels += sub_pixels
+
+	return n, pixels
+
+def make_cost_report(img):
+	frames = list(get_frames(img))
+
+	frame_costs = [ get_layer_cost(img, frame.layer) for frame in frames ]
+	for frame, cost in zip(frames, frame_costs):
+		cost['paged'] = frame.layer.parasite_find(PAGED_PARASITE) is not None
+
+	sub_layers = {}
+	mostly_empty = []
+	for cost in _walk_costs(frame_costs):
+		if 'layers' in cost:
+			continue
+
+		sub_layers[cost['sub_layer']] = sub_layers.get(cost['sub_layer'], 0) + cost['bytes']
+
+		if cost.get('coverage', 1.) < EMPTY_COVERAGE:
+			mostly_empty.append(cost['name'])
+
+	other_costs = [ get_layer_cost(img, layer) for layer in img.layers
+			if layer.name.startswith('[') ]
+
+	layers, pixels = get_compositing_cost(img.layers)
+
+	if frames:
+		current = frames[Context.from_frames(frames).current_index].layer.name
+	else:
+		current = None
+
+	return {
+		'format': REPORT_FORMAT,
+		'width': img.width,
+		'height': img.height,
+		'bytes': sum(cost['bytes'] for cost in frame_costs + other_costs),
+		'frames': frame_costs,
+		'backgrounds': other_costs,
+		'sub_layers': sub_layers,
+		'mostly_empty': mostly_empty,
+		'compositing': {
+			'current_frame': current,
+			'layers': layers,
+			'pixels': pixels,
+		},
+	}
+
+def onion_cost_report(img, act_layer, filename):
+	if not filename:
+		if img.filename:
+			filename = os.path.splitext(img.filename)[0] + '-onion-report.json'
+		else:
+			filename = os.path.join(LOCK_DIR, 'gimp-plugin-onion-layers-report.json')
+
+	report = make_cost_report(img)
+
+	with open(filename, "w") as f:
+		json.dump(report, f, indent=1, sort_keys=True)
+
+	pdb.gimp_message("%.1f MB in %d frames, %d mostly empty layers. "
+			"Showing the current frame composites %d layers.\n"
+			"Report saved to %s" % (
+				report['bytes'] / 1e6, len(report['frames']),
+				len(report['mostly_empty']), report['compositing']['layers'],
+				filename))
+
+def onion_sort_frames(img, act_layer):
+	layers = img.layers
+
+	# Top of the stack is the last frame, so sort by falling frame numbers.
+	# [Background] layers and frames without a number stay where they are.
+	keys = []
+	for layer in layers:
+		num = None
+		if not layer.name.startswith('['):
+			num = NumberedName.from_layer_name(layer.name).num
+
+		if num is None:
+			keys.append(None)
+		else:
+			keys.append(-num)
+
+	moves = plan_sort_moves(keys)
+	if not moves:
+		return
+
+	img.undo_group_start()
+
+	for i, position in moves:
+		pdb.gimp_image_reorder_item(img, layers[i], None, position)
+
+	img.undo_group_end()
+
+def get_frame_number(frame):
+	return NumberedName.from_layer_name(frame.layer.name).num
+
+# Returns stack indices of frames with numbers between first and last
+# (inclusive), top of the stack first.
+def get_frame_range(frames, first, last):
+	indices = []
+	for n, frame in enumerate(frames):
+		num = get_frame_number(frame)
+		if (num is not None) and (first <= num <= last):
+			indices.append(n)
+
+	return indices
+
+def onion_duplicate_frames(img, act_layer, first, last, copy_pixels):
+	frames = list(get_frames(img))
+
+	indices = get_frame_range(frames, first, last)
+	if not indices:
+		pdb.gimp_message("No frames numbered from %d to %d." % (first, last))
+		return
+
+	# Copies go after the last frame in the range, which is the top-most
+	# one in the stack.
+	top = indices[0]
+
+	name = NumberedName.from_layer_name(frames[top].layer.name)
+	next_num = get_next_frame_number(frames, top)
+
+	try:
+		nums = spread_numbers(name.num, next_num, len(indices),
+				name.get_new_frame_increment())
+	except ValueError:
+		pdb.gimp_message("Not enough free frame numbers after frame %s. "
+				"Renumber frames first." % (frames[top].layer.name,))
+		return
+
+	pager = Pager.from_image(img)
+
+	img.undo_group_start()
+
+	position = pdb.gimp_image_get_item_position(img, frames[top].layer)
+
+	# Bottom of the stack is the first frame. Each copy is inserted above
+	# the previous one.
+	for n, num in zip(reversed(indices), nums):
+		frame = frames[n]
+
+		if pager is not None:
+			pager.page_in(img, frame)
+
+		if copy_pixels:
+			new_layer = frame.layer.copy()
+			pdb.gimp_image_insert_layer(img, new_layer, None, position)
+			set_frame_number(new_layer, num, frame.layer)
+			clean_frame_copy(img, new_layer)
+		else:
+			new_name = NumberedName.from_layer_name(frame.layer.name)
+			new_name.num = num
+			new_layer = add_blank_frame(img, frame.layer, new_name, position)
+
+			# Keep timing of the range the same.
+			Frame(new_layer).set_hold(frame.get_hold())
+
+		# Copies are hidden, so that the current frame stays the same.
+		new_layer.visible = False
+
+	img.undo_group_end()
+
+def onion_delete_frames(img, act_layer, first, last):
+	frames = list(get_frames(img))
+
+	indices = get_frame_range(frames, first, last)
+	if not indices:
+		pdb.gimp_message("No frames numbered from %d to %d." % (first, last))
+		return
+
+	contextobj = onion(img, act_layer, 0, dryrun=True)
+
+	img.undo_group_start()
+
+	for n in indices:
+		pdb.gimp_image_remove_layer(img, frames[n].layer)
+
+	# If the current frame was deleted, the frame before the deleted
+	# range becomes the current frame.
+	i = contextobj.current_index
+	if i in indices:
+		i = indices[-1] + 1
+	i -= len([ n for n in indices if n < i ])
+
+	N = len(frames) - len(indices)
+	if N > 0:
+		contextobj.current_index = min(i, N - 1)
+		onion(img, img.active_layer, 0, contextobj)
+
+	img.undo_group_end()
+
+def onion_shift_frames(img, act_layer, first, last, offset):
+	frames = list(get_frames(img))
+
+	indices = get_frame_range(frames, first, last)
+	if not indices:
+		pdb.gimp_message("No frames numbered from %d to %d." % (first, last))
+		return
+
+	if offset == 0:
+		return
+
+	nums = [ get_frame_number(frames[n]) for n in indices ]
+
+	# Frames must stay between their neighbors outside of the range,
+	# otherwise the stack would no longer be in order.
+	top = indices[0]
+	bottom = indices[-1]
+
+	low = get_prev_frame_number(frames, bottom)
+	if low is None:
+		low = -1
+
+	high = get_next_frame_number(frames, top)
+
+	if (min(nums) + offset <= low) or ((high is not None) and (max(nums) + offset >= high)):
+		pdb.gimp_message("Can't shift frames %d to %d by %d without "
+				"passing other frames." % (first, last, offset))
+		return
+
+	img.undo_group_start()
+
+	move_frame_numbers([ (frames[n].layer, num, num + offset)
+			for n, num in zip(indices, nums) ])
+
+	img.undo_group_end()
+
+# Plans numbers for k new frames after frame i. Returns (new numbers, moves),
+# where moves are number changes of the following frames (see
+# move_frame_numbers) that make room for the new frames. Only as many
+# following frames are renumbered as needed to find a large enough gap.
+# Unnumbered frames are left alone.
+def plan_frame_gap(frames, i, k):
+	name = NumberedName.from_layer_name(frames[i].layer.name)
+	a = name.num
+
+	# Numbered frames after frame i, nearest first.
+	following = [ (frame.layer, get_frame_number(frame))
+			for frame in reversed(frames[:i]) ]
+	following = [ (layer, num) for layer, num in following if num is not None ]
+
+	j = 0
+	while True:
+		# Following frames 0 ... j-1 are renumbered, frame j stays.
+		if j < len(following):
+			b = following[j][1]
+		else:
+			b = None
+
+		try:
+			nums = spread_numbers(a, b, k + j, name.get_new_frame_increment())
+		except ValueError:
+			j += 1
+			continue
+
+		moves = []
+		for m in range(j):
+			layer, num = following[m]
+			moves.append((layer, num, nums[k + m]))
+
+		return nums[:k], moves
+
+def onion_splice_frames(img, act_layer, src_img, first, last):
+	if src_img == img:
+		pdb.gimp_message("Choose a different image to splice frames from.")
+		return
+
+	frames = list(get_frames(img))
+
+	# If no frames were found, do nothing.
+	N = len(frames)
+	if N < 1:
+		return
+
+	src_frames = list(get_frames(src_img))
+	indices = get_frame_range(src_frames, first, last)
+	if not indices:
+		pdb.gimp_message("No frames numbered from %d to %d." % (first, last))
+		return
+
+	contextobj = onion(img, act_layer, 0, dryrun=True)
+	i = contextobj.current_index
+
+	if get_frame_number(frames[i]) is None:
+		pdb.gimp_message("Current frame %s has no number." % (frames[i].layer.name,))
+		return
+
+	nums, moves = plan_frame_gap(frames, i, len(indices))
+	width = NumberedName.from_layer_name(frames[i].layer.name).width
+
+	src_context_hidden = (get_context_layers(src_img) is not None)
+
+	src_pager = Pager.from_image(src_img)
+	if src_pager is not None:
+		src_img.undo_group_start()
+		for n in indices:
+			src_pager.page_in(src_img, src_frames[n])
+		src_img.undo_group_end()
+
+	img.undo_group_start()
+
+	move_frame_numbers(moves)
+
+	position = pdb.gimp_image_get_item_position(img, frames[i].layer)
+
+	# Bottom of the stack is the first frame. Each frame is inserted above
+	# the previous one. Whole groups are copied at once.
+	for n, num in zip(reversed(indices), nums):
+		src_frame = src_frames[n]
+
+		new_layer = pdb.gimp_layer_new_from_drawable(src_frame.layer, img)
+		pdb.gimp_image_insert_layer(img, new_layer, None, position)
+		set_frame_number(new_layer, num, src_frame.layer, width)
+		clean_frame_copy(img, new_layer, src_context_hidden)
+
+		new_layer.visible = False
+
+	# quick dirty check if tinting was used
+	do_tint = (pdb.gimp_image_get_layer_by_name(img, "onion-tint-after") is not None)
+
+	contextobj.current_index = i + len(indices)
+	onion(img, act_layer, 0, contextobj, do_tint=do_tint)
+
+	img.undo_group_end()
+
+def onion_renumber_frames(img, act_layer):
+	img.undo_group_start()
+
+	renumber_frames(img)
+
+	img.undo_group_end()
+
+def find_duplicate_frames(img):
+	page_in_all(img)
+
+	frames = list(get_frames(img))
+	hashes = [ frame.get_content_hash() for frame in frames ]
+
+	page_out_far_frames(img)
+
+	return frames, find_identical_runs(hashes)
+
+def onion_find_duplicates(img, act_layer):
+	frames, runs = find_duplicate_frames(img)
+
+	if not runs:
+		pdb.gimp_message("No identical frames found.")
+		return
+
+	lines = []
+	for start, end in runs:
+		# Top of the stack is the last frame.
+		lines.append("%s - %s (%d identical frames)" % (
+			frames[end].layer.name, frames[start].layer.name, end - start + 1))
+
+	pdb.gimp_message("Identical frames:\n" + "\n".join(lines))
+
+def onion_collapse_duplicates(img, act_layer):
+	frames, runs = find_duplicate_frames(img)
+	if not runs:
+		return
+
+	act_frame = act_layer
+	while act_frame.parent is not None:
+		act_frame = act_frame.parent
+
+	contextobj = onion(img, act_layer, 0, dryrun=True)
+	i = contextobj.current_index
+
+	img.undo_group_start()
+
+	removed = 0
+	for start, end in runs:
+		# Keep the earliest frame of the run (the lowest in the stack)
+		# and hold it for the duration of the whole run.
+		keep = frames[end]
+
+		hold = 0
+		for frame in frames[start:end+1]:
+			hold += frame.get_hold()
+
+		# If we remove the current frame, make the kept frame
+		# current instead.
+		if start <= i < end:
+			i = end
+
+		for frame in frames[start:end]:
+			if frame.layer == act_frame:
+				act_layer = keep.layer
+
+			pdb.gimp_image_remove_layer(img, frame.layer)
+
+		if end <= i:
+			removed += end - start
+
+		keep.set_hold(hold)
+
+	img.active_layer = act_layer
+
+	# quick dirty check if tinting was used
+	do_tint = (pdb.gimp_image_get_layer_by_name(img, "onion-tint-after") is not None)
+
+	contextobj.current_index = i - removed
+	onion(img, act_layer, 0, contextobj, do_tint=do_tint)
+
+	img.undo_group_end()
+
+def onion_expand_holds(img, act_layer):
+	page_in_all(img)
+
+	frames = list(get_frames(img))
+
+	def get_new_numbers(n, hold):
+		num = NumberedName.from_layer_name(frames[n].layer.name)
+		if num.num is None:
+			raise ValueError
+
+		next_num = get_next_frame_number(frames, n)
+
+		return spread_numbers(num.num, next_num, hold - 1,
+				num.get_new_frame_increment())
+
+	# Check first that we have space for all copies, so that we
+	# don't leave the image half-expanded.
+	holds = [ frame.get_hold() for frame in frames ]
+	try:
+		for n, hold in enumerate(holds):
+			if hold > 1:
+				get_new_numbers(n, hold)
+	except ValueError:
+		pdb.gimp_message("Not enough free frame numbers to expand holds. "
+				"Renumber frames first.")
+		page_out_far_frames(img)
+		return
+
+	img.undo_group_start()
+
+	for n, hold in enumerate(holds):
+		if hold <= 1:
+			continue
+
+		frame = frames[n]
+		pos = pdb.gimp_image_get_item_position(img, frame.layer)
+
+		for num in get_new_numbers(n, hold):
+			new_layer = frame.layer.copy()
+			pdb.gimp_image_insert_layer(img, new_layer, None, pos)
+			set_frame_number(new_layer, num, frame.layer)
+			clean_frame_copy(img, new_layer)
+
+			# Copies are hidden. Otherwise the current frame
+			# might no longer be detected correctly.
+			new_layer.visible = False
+			Frame(new_layer).set_hold(1)
+
+		frame.set_hold(1)
+
+	img.undo_group_end()
+
+	page_out_far_frames(img)
+
+# Thumbnails are cached on disk, keyed by the frame content hash. Rendering
+# goes through the PDB, which only one thread can use, but compressing and
+# reading or writing cache files is done in a pool of worker threads while
+# the next frame is being rendered.
+
+THUMBNAIL_DIR = os.path.join(LOCK_DIR, 'gimp-plugin-onion-layers-thumbnails')
+THUMBNAIL_WORKERS = 4
+THUMBNAIL_PADDING = 8
+
+class ThumbnailCache(object):
+	def __init__(self, path=THUMBNAIL_DIR):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+	def _get_filename(self, key, width, height):
+		return os.path.join(self.path, "%s-%dx%d.rgba.z" % (key, width, height))
+
+	def load(self, key, width, height):
+		try:
+			with open(self._get_filename(key, width, height), "rb") as f:
+				return zlib.decompress(f.read())
+		except (IOError, OSError, zlib.error):
+			return None
+
+	def store(self, key, width, height, data):
+		path = self._get_filename(key, width, height)
+
+		# Write to a temporary file first, so that a partially written
+		# thumbnail is never read.
+		tmp_path = "%s.%d.tmp" % (path, os.getpid())
+		with open(tmp_path, "wb") as f:
+			f.write(zlib.compress(data))
+		os.rename(tmp_path, path)
+
+# Returns the size of the contact sheet and the position of each thumbnail.
+def get_contact_sheet_layout(n, columns, width, height, padding=THUMBNAIL_PADDING):
+	columns = max(1, min(columns, n))
+	rows = (n + columns - 1) // columns
+
+	sheet_width = columns*(width + padding) + padding
+	sheet_height = rows*(height + padding) + padding
+
+	positions = []
+	for i in range(n):
+		x = padding + (i % columns)*(width + padding)
+		y = padding + (i // columns)*(height + padding)
+		positions.append((x, y))
+
+	return sheet_width, sheet_height, positions
+
+def render_thumbnail(img, frame, width, height):
+	# Copy the frame alone into a temporary image and scale down what
+	# is visible there.
+	tmp = pdb.gimp_image_new(img.width, img.height, 0)
+
+	layer = pdb.gimp_layer_new_from_drawable(frame.layer, tmp)
+	pdb.gimp_image_insert_layer(tmp, layer, None, 0)
+	layer.visible = True
+	layer.opacity = 100.
+
+	if hasattr(layer, 'layers'):
+		for sub_layer in layer.layers:
+			if frame.TINT_PREFIX in sub_layer.name:
+				pdb.gimp_image_remove_layer(tmp, sub_layer)
+			elif is_context_hidden(sub_layer):
+				sub_layer.visible = True
+
+	thumbnail = pdb.gimp_layer_new_from_visible(tmp, tmp, "thumbnail")
+	pdb.gimp_image_insert_layer(tmp, thumbnail, None, 0)
+	pdb.gimp_layer_scale(thumbnail, width, height, False)
+
+	rgn = thumbnail.get_pixel_rgn(0, 0, width, height, False, False)
+	data = rgn[0:width, 0:height]
+
+	pdb.gimp_image_delete(tmp)
+
+	return data
+
+def onion_contact_sheet(img, act_layer, width, columns):
+	page_in_all(img)
+
+	frames = list(get_frames(img))
+
+	# If no frames were found, do nothing.
+	N = len(frames)
+	if N < 1:
+		return
+
+	# Top of the stack is the last frame.
+	frames.reverse()
+
+	width = max(1, min(width, img.width))
+	height = max(1, (img.height*width) // img.width)
+
+	cache = ThumbnailCache()
+	pool = ThreadPool(THUMBNAIL_WORKERS)
+
+	keys = [ frame.get_content_hash() for frame in frames ]
+	thumbnails = pool.map(lambda key: cache.load(key, width, height), keys)
+
+	for n, frame in enumerate(frames):
+		if thumbnails[n] is None:
+			thumbnails[n] = render_thumbnail(img, frame, width, height)
+			pool.apply_async(cache.store, (keys[n], width, height, thumbnails[n]))
+
+	page_out_far_frames(img)
+
+	sheet_width, sheet_height, positions = get_contact_sheet_layout(N, columns, width, height)
+
+	sheet = pdb.gimp_image_new(sheet_width, sheet_height, 0)
+
+	background = pdb.gimp_layer_new(sheet, sheet_width, sheet_height, 1, "background", 100, 0)
+	pdb.gimp_image_insert_layer(sheet, background, None, 0)
+	pdb.gimp_drawable_fill(background, 2)
+
+	layer = pdb.gimp_layer_new(sheet, sheet_width, sheet_height, 1, "frames", 100, 0)
+	pdb.gimp_image_insert_layer(sheet, layer, None, 0)
+	pdb.gimp_drawable_fill(layer, 3)
+
+	rgn = layer.get_pixel_rgn(0, 0, sheet_width, sheet_height, True, False)
+	for (x, y), data in zip(positions, thumbnails):
+		rgn[x:x+width, y:y+height] = data
+
+	layer.flush()
+	layer.update(0, 0, sheet_width, sheet_height)
+
+	pool.close()
+	pool.join()
+
+	gimp.Display(sheet)
+	gimp.displays_flush()
+
+def start():
+	register(
+		"python_fu_onion_up",
+		"Onion up",
+		"Move one onion layer up",
+		"Tomaz Solc",
+		"Open source (BSD 3-clause license)",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/up",
+		"*",
+		[],
+		[],
+		onion_up)
+
+	register(
+		"python_fu_onion_down",
+		"Onion down",
+		"Move one onion layer down",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/down",
+		"*",
+		[],
+		[],
+		onion_down)
+
+	register(
+		"python_fu_onion_up_ctx",
 		"Onion up, contex",
 		"Move one onion layer up, show next/prev frame",
 		"Tomaz Solc",
@@ -733,6 +2372,32 @@ def start():
 		[],
 		onion_down_ctx_auto_tint)
 
+	register(
+		"python_fu_onion_up_ctx_auto_tint_adaptive",
+		"Onion up, auto context, tint, adaptive",
+		"Move one onion layer up, retain current context. When stepping through frames quickly, tinting is delayed until you stop.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/up, auto, tint, adaptive",
+		"*",
+		[],
+		[],
+		onion_up_ctx_auto_tint_adaptive)
+
+	register(
+		"python_fu_onion_down_ctx_auto_tint_adaptive",
+		"Onion down, auto context, tint, adaptive",
+		"Move one onion layer down, retain current context. When stepping through frames quickly, tinting is delayed until you stop.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/down, auto, tint, adaptive",
+		"*",
+		[],
+		[],
+		onion_down_ctx_auto_tint_adaptive)
+
 	register(
 		"python_fu_onion_cycle_ctx",
 		"Cycle through frame contexts",
@@ -759,6 +2424,49 @@ def start():
 		[],
 		onion_cycle_context_tint)
 
+	register(
+		"python_fu_onion_set_context_layers",
+		"Set layers shown in neighboring frames",
+		"Neighboring frames only show layers with the given names (comma separated, e.g. \"outline\"). Leave empty to show all layers.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Context layers...",
+		"*",
+		[
+			(PF_STRING, "names", "Layer names", "outline"),
+		],
+		[],
+		onion_set_context_layers)
+
+	register(
+		"python_fu_onion_enable_paging",
+		"Keep only nearby frames in memory",
+		"Layers of frames further away from the current frame than the given distance are moved to disk and read back when needed.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Enable paging...",
+		"*",
+		[
+			(PF_INT, "distance", "Frames to keep in memory on each side", 10),
+		],
+		[],
+		onion_enable_paging)
+
+	register(
+		"python_fu_onion_disable_paging",
+		"Keep all frames in memory",
+		"Reads all frames back from disk and stops moving frames to disk.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Disable paging",
+		"*",
+		[],
+		[],
+		onion_disable_paging)
+
 	register(
 		"python_fu_onion_show_all",
 		"Show all frames",
@@ -849,6 +2557,203 @@ def start():
 		[],
 		[],
 		onion_renumber_frames)
+
+	register(
+		"python_fu_onion_duplicate_frames",
+		"Duplicate a range of frames",
+		"Inserts copies of frames with numbers from first to last after the last one.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Duplicate frames...",
+		"*",
+		[
+			(PF_INT, "first", "First frame number", 0),
+			(PF_INT, "last", "Last frame number", 0),
+			(PF_TOGGLE, "copy_pixels", "Copy drawings (otherwise blank layers)", True),
+		],
+		[],
+		onion_duplicate_frames)
+
+	register(
+		"python_fu_onion_delete_frames",
+		"Delete a range of frames",
+		"Deletes frames with numbers from first to last.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Delete frames...",
+		"*",
+		[
+			(PF_INT, "first", "First frame number", 0),
+			(PF_INT, "last", "Last frame number", 0),
+		],
+		[],
+		onion_delete_frames)
+
+	register(
+		"python_fu_onion_shift_frames",
+		"Shift numbers of a range of frames",
+		"Adds an offset to the numbers of frames from first to last.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Shift frame numbers...",
+		"*",
+		[
+			(PF_INT, "first", "First frame number", 0),
+			(PF_INT, "last", "Last frame number", 0),
+			(PF_INT, "offset", "Offset", 0),
+		],
+		[],
+		onion_shift_frames)
+
+	register(
+		"python_fu_onion_splice_frames",
+		"Splice frames from another image",
+		"Copies frames with numbers from first to last from another open image after the current frame. Following frames are renumbered only as far as needed to make room.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Splice frames...",
+		"*",
+		[
+			(PF_IMAGE, "src_img", "Image to copy frames from", None),
+			(PF_INT, "first", "First frame number", 0),
+			(PF_INT, "last", "Last frame number", 0),
+		],
+		[],
+		onion_splice_frames)
+
+	register(
+		"python_fu_onion_sort_frames",
+		"Sort frames by number",
+		"Reorders frames in the stack by the numbers in their names. Background layers stay where they are.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Sort frames",
+		"*",
+		[],
+		[],
+		onion_sort_frames)
+
+	register(
+		"python_fu_onion_cost_report",
+		"Report memory use of frames",
+		"Saves a JSON report of memory used by each frame and layer, mostly empty layers and the cost of showing the current frame.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Memory report...",
+		"*",
+		[
+			(PF_STRING, "filename", "Report file (empty for next to the image)", ""),
+		],
+		[],
+		onion_cost_report)
+
+	register(
+		"python_fu_onion_set_sub_layer",
+		"Set layer visibility in all frames",
+		"Sets visibility and opacity of the layer with the given name in all frames.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Set layer in all frames...",
+		"*",
+		[
+			(PF_STRING, "name", "Layer name", "sketch"),
+			(PF_TOGGLE, "visible", "Visible", False),
+			(PF_SLIDER, "opacity", "Opacity", 100, (0, 100, 1)),
+		],
+		[],
+		onion_set_sub_layer)
+
+	register(
+		"python_fu_onion_save_preset",
+		"Save layer preset",
+		"Saves visibility and opacity of layers in the current frame as a named preset.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Save layer preset...",
+		"*",
+		[
+			(PF_STRING, "preset", "Preset name", "default"),
+		],
+		[],
+		onion_save_preset)
+
+	register(
+		"python_fu_onion_apply_preset",
+		"Apply layer preset",
+		"Applies a saved layer visibility and opacity preset to all frames.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Apply layer preset...",
+		"*",
+		[
+			(PF_STRING, "preset", "Preset name", "default"),
+		],
+		[],
+		onion_apply_preset)
+
+	register(
+		"python_fu_onion_find_duplicates",
+		"Find identical frames",
+		"Shows runs of consecutive frames that are pixel-identical.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Find identical frames",
+		"*",
+		[],
+		[],
+		onion_find_duplicates)
+
+	register(
+		"python_fu_onion_collapse_duplicates",
+		"Collapse identical frames into holds",
+		"Replaces each run of identical consecutive frames with a single frame that is held for the length of the run.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Collapse identical frames",
+		"*",
+		[],
+		[],
+		onion_collapse_duplicates)
+
+	register(
+		"python_fu_onion_expand_holds",
+		"Expand held frames",
+		"Replaces each held frame with the corresponding number of copies.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Expand held frames",
+		"*",
+		[],
+		[],
+		onion_expand_holds)
+
+	register(
+		"python_fu_onion_contact_sheet",
+		"Make a contact sheet of all frames",
+		"Opens a new image with thumbnails of all frames. Thumbnails are cached, so only frames that changed are rendered again.",
+		"Tomaz Solc",
+		"GPLv3+",
+		"2022",
+		"<Image>/Filters/Animation/Onion layers/Contact sheet...",
+		"*",
+		[
+			(PF_INT, "width", "Thumbnail width", 160),
+			(PF_INT, "columns", "Columns", 8),
+		],
+		[],
+		onion_contact_sheet)
 	main()
 
 if __name__ == "__main__":
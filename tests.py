@@ -1,6 +1,1460 @@
+import os
+import random
+import shutil
+import tempfile
 import unittest
 
-from onion_layers import NumberedName, flocked, get_middle_number
+import onion_layers
+from onion_layers import NumberedName, flocked, get_middle_number, \
+		find_identical_runs, spread_numbers, get_frames, Context, Frame, \
+		DEFAULT_CONTEXTS, NEXT_PREV_OPACITY, LatencyBudget, LATENCY_BUDGET, \
+		ThumbnailCache, get_contact_sheet_layout, plan_sort_moves, \
+		get_heaviest_increasing_subsequence
+
+# A minimal stand-in for the parts of the GIMP image model and PDB that the
+# plug-in uses. It counts PDB calls and attribute writes made by the plug-in,
+# so that tests can check how much work each operation does.
+#
+# Like gimpfu, "layers" attributes return a new list on each access. Unlike
+# GIMP, layer names are not made unique automatically - tests check that the
+# plug-in never produces duplicate names instead.
+
+class FakeCounters(object):
+	def __init__(self):
+		self.pdb_calls = 0
+		self.writes = 0
+
+class FakeParasite(object):
+	def __init__(self, name, flags, data):
+		self.name = name
+		self.flags = flags
+		self.data = data
+
+class FakePixelRegion(object):
+	# Only whole-layer reads and writes are supported.
+	def __init__(self, layer):
+		self.layer = layer
+
+	def __getitem__(self, key):
+		return self.layer._pixels
+
+	def __setitem__(self, key, value):
+		assert not self.layer._lock_content
+		self.layer._pixels = value
+
+class FakeItem(object):
+	def __init__(self, counters, **kwargs):
+		self._counters = counters
+		for k, v in kwargs.items():
+			object.__setattr__(self, k, v)
+
+	def __setattr__(self, name, value):
+		if not name.startswith('_'):
+			self._counters.writes += 1
+		object.__setattr__(self, name, value)
+
+	def _set(self, name, value):
+		# internal updates made by the fake PDB are not counted
+		object.__setattr__(self, name, value)
+
+	# In gimpfu, parasite methods are PDB calls.
+	def parasite_find(self, name):
+		self._counters.pdb_calls += 1
+		return self._parasites.get(name)
+
+	def attach_new_parasite(self, name, flags, data):
+		self._counters.pdb_calls += 1
+		self._parasites[name] = FakeParasite(name, flags, data)
+
+	def parasite_detach(self, name):
+		self._counters.pdb_calls += 1
+		del self._parasites[name]
+
+	def parasite_list(self):
+		self._counters.pdb_calls += 1
+		return tuple(self._parasites.keys())
+
+class FakeLayer(FakeItem):
+	def __init__(self, counters, name, width=64, height=64, opacity=100., visible=True, mode=0):
+		FakeItem.__init__(self, counters,
+				name=name, width=width, height=height,
+				opacity=opacity, visible=visible, mode=mode,
+				offsets=(0, 0), bpp=4, has_alpha=True, type=1,
+				parent=None, mask=None, edit_mask=False,
+				apply_mask=False, show_mask=False, lock_alpha=False, linked=False)
+		self._parasites = {}
+		self._pixels = b''
+		self._coverage = 1.
+		self._lock_content = False
+		self._lock_position = False
+		self._color_tag = 0
+
+	def copy(self):
+		layer = self._new(self.name + " copy")
+		for k in ('width', 'height', 'opacity', 'visible', 'mode', 'offsets', 'bpp', 'type'):
+			layer._set(k, getattr(self, k))
+		layer._parasites = dict(self._parasites)
+		layer._pixels = self._pixels
+		return layer
+
+	def _new(self, name):
+		return FakeLayer(self._counters, name)
+
+	def get_pixel_rgn(self, x, y, width, height, dirty, shadow):
+		return FakePixelRegion(self)
+
+	def set_offsets(self, x, y):
+		assert not self._lock_position
+		self.offsets = (x, y)
+
+	def create_mask(self, mask_type):
+		mask = FakeLayer(self._counters, self.name + " mask")
+		mask._pixels = b'\xff' * len(self._pixels)
+		return mask
+
+	def add_mask(self, mask):
+		self._set('mask', mask)
+		self._set('apply_mask', True)
+
+	def flush(self):
+		pass
+
+	def update(self, x, y, width, height):
+		pass
+
+class FakeGroup(FakeLayer):
+	def __init__(self, counters, name, **kwargs):
+		FakeLayer.__init__(self, counters, name, **kwargs)
+		self._layers = []
+
+	@property
+	def layers(self):
+		return list(self._layers)
+
+	def copy(self):
+		group = FakeLayer.copy(self)
+		for layer in self._layers:
+			child = layer.copy()
+			child._set('parent', group)
+			group._layers.append(child)
+		return group
+
+	def _new(self, name):
+		return FakeGroup(self._counters, name)
+
+class FakeImage(FakeItem):
+	def __init__(self, counters, width=64, height=64):
+		FakeItem.__init__(self, counters, width=width, height=height,
+				active_layer=None)
+		self._layers = []
+		self._undo_depth = 0
+		self._parasites = {}
+
+	@property
+	def layers(self):
+		return list(self._layers)
+
+	def undo_group_start(self):
+		self._undo_depth += 1
+
+	def undo_group_end(self):
+		assert self._undo_depth > 0
+		self._undo_depth -= 1
+
+	def _container(self, parent):
+		if parent is None:
+			return self._layers
+		else:
+			return parent._layers
+
+	def _walk(self, layers=None):
+		if layers is None:
+			layers = self._layers
+		for layer in layers:
+			yield layer
+			if hasattr(layer, '_layers'):
+				for sub_layer in self._walk(layer._layers):
+					yield sub_layer
+
+class FakePDB(object):
+	def __init__(self, counters):
+		self.counters = counters
+		self.messages = []
+		self.foreground = (0, 0, 0)
+
+	def _call(self):
+		self.counters.pdb_calls += 1
+
+	def gimp_message(self, msg):
+		self._call()
+		self.messages.append(msg)
+
+	def gimp_image_get_layer_by_name(self, img, name):
+		self._call()
+		for layer in img._walk():
+			if layer.name == name:
+				return layer
+		return None
+
+	def gimp_layer_new(self, img, width, height, type, name, opacity, mode):
+		self._call()
+		layer = FakeLayer(self.counters, name, width, height, opacity, mode=mode)
+		layer._set('type', type)
+		return layer
+
+	def gimp_layer_group_new(self, img):
+		self._call()
+		return FakeGroup(self.counters, "Layer Group")
+
+	def gimp_image_insert_layer(self, img, layer, parent, position):
+		self._call()
+		layer._set('parent', parent)
+		img._container(parent).insert(position, layer)
+
+	def gimp_layer_new_from_drawable(self, drawable, dest_img):
+		self._call()
+		return drawable.copy()
+
+	def gimp_image_remove_layer(self, img, layer):
+		self._call()
+		img._container(layer.parent).remove(layer)
+
+	def gimp_image_reorder_item(self, img, item, parent, position):
+		self._call()
+		img._container(item.parent).remove(item)
+		item._set('parent', parent)
+		img._container(parent).insert(position, item)
+
+	def gimp_image_get_item_position(self, img, item):
+		self._call()
+		return img._container(item.parent).index(item)
+
+	def gimp_context_get_foreground(self):
+		self._call()
+		return self.foreground
+
+	def gimp_context_set_foreground(self, color):
+		self._call()
+		self.foreground = color
+
+	def gimp_edit_fill(self, drawable, fill_type):
+		self._call()
+
+	def gimp_item_get_lock_content(self, item):
+		self._call()
+		return item._lock_content
+
+	def gimp_item_set_lock_content(self, item, lock_content):
+		self._call()
+		item._lock_content = lock_content
+
+	def gimp_item_get_lock_position(self, item):
+		self._call()
+		return item._lock_position
+
+	def gimp_item_set_lock_position(self, item, lock_position):
+		self._call()
+		item._lock_position = lock_position
+
+	def gimp_item_get_color_tag(self, item):
+		self._call()
+		return item._color_tag
+
+	def gimp_item_set_color_tag(self, item, color_tag):
+		self._call()
+		item._color_tag = color_tag
+
+	def gimp_drawable_histogram(self, drawable, channel, start_range, end_range):
+		self._call()
+		pixels = drawable.width * drawable.height
+		count = int(pixels * drawable._coverage)
+		return 0., 0., 0., pixels, count, float(count) / pixels
+
+class FakeGimpTestCase(unittest.TestCase):
+	SUB_LAYER_NAMES = [ 'outline', 'shading', 'color', 'sketch' ]
+
+	def setUp(self):
+		self.counters = FakeCounters()
+		self.pdb = FakePDB(self.counters)
+		self.old_pdb = getattr(onion_layers, 'pdb', None)
+		onion_layers.pdb = self.pdb
+
+	def tearDown(self):
+		onion_layers.pdb = self.old_pdb
+
+	# With sub_layers=None, each group gets a random number of sub-layers.
+	def make_image(self, rnd, nframes, groups=True, backgrounds=0, sub_layers=None):
+		img = FakeImage(self.counters)
+
+		# Top of the stack is the last frame.
+		for n in reversed(range(nframes)):
+			num = NumberedName('frame', n*100, 4)
+			if groups is True or (groups is None and rnd.random() < .7):
+				frame = FakeGroup(self.counters, num.to_string(), visible=False)
+				if sub_layers is None:
+					nsub = rnd.randint(1, len(self.SUB_LAYER_NAMES))
+				else:
+					nsub = sub_layers
+				for name in self.SUB_LAYER_NAMES[:nsub]:
+					sub_num = NumberedName(name, num.num, num.width)
+					layer = FakeLayer(self.counters, sub_num.to_string())
+					layer._set('parent', frame)
+					frame._layers.append(layer)
+			else:
+				frame = FakeLayer(self.counters, num.to_string(), visible=False)
+
+			img._layers.append(frame)
+
+		for n in range(backgrounds):
+			bg = FakeLayer(self.counters, "[bg%d]" % (n,))
+			img._layers.insert(rnd.randint(0, len(img._layers)), bg)
+
+		# Show the first frame.
+		frames = list(get_frames(img))
+		frames[-1].layer._set('visible', True)
+		img._set('active_layer', self.get_sub_layer(frames[-1].layer, rnd))
+
+		return img
+
+	def get_sub_layer(self, frame_layer, rnd):
+		if hasattr(frame_layer, 'layers') and frame_layer.layers:
+			return rnd.choice(frame_layer.layers)
+		else:
+			return frame_layer
+
+	def reset_counters(self):
+		self.counters.pdb_calls = 0
+		self.counters.writes = 0
+
+	def get_current(self, img):
+		frames = list(get_frames(img))
+		current = [ n for n, frame in enumerate(frames)
+				if frame.layer.visible and (frame.layer.opacity == 100.) ]
+		self.assertEqual(1, len(current))
+		return current[0]
+
+	def get_tint_layers(self, img):
+		return [ layer for layer in img._walk()
+				if layer.name.startswith(Frame.TINT_PREFIX) ]
+
+	def check_invariants(self, img):
+		self.assertEqual(0, img._undo_depth)
+
+		names = [ layer.name for layer in img._walk() ]
+		self.assertEqual(len(names), len(set(names)))
+
+		self.get_current(img)
+
+		# Visible tint layers can only be in visible frames that are
+		# not the current frame.
+		for layer in img._walk():
+			if layer.name.startswith(Frame.TINT_PREFIX) and layer.visible:
+				self.assertTrue(layer.parent.visible)
+				self.assertTrue(layer.parent.opacity < 100.)
+
+	def check_context(self, img, i, context):
+		frames = list(get_frames(img))
+		N = len(frames)
+
+		self.assertEqual(i, self.get_current(img))
+
+		if N < Context.SIZE*2 + 1:
+			return
+
+		contextobj = Context.from_frames(frames)
+		self.assertEqual(i, contextobj.current_index)
+
+		if len(context) == 1:
+			expected = [ None, 100., None ]
+		else:
+			expected = list(context)
+		self.assertEqual(expected, contextobj.context)
+
+		for n, frame in enumerate(frames):
+			if abs(n - i) > Context.SIZE and abs(n - i) < N - Context.SIZE:
+				self.assertFalse(frame.layer.visible)
+
+class TestOnionRandomized(FakeGimpTestCase):
+	def step(self, img, rnd):
+		frames = list(get_frames(img))
+		N = len(frames)
+
+		before = Context.from_frames(frames)
+
+		inc = rnd.choice([ -1, 0, 1 ])
+		do_tint = rnd.choice([ True, False ])
+
+		act_layer = img.active_layer
+
+		kind = rnd.randint(0, 2)
+		if kind == 0:
+			context = rnd.choice(DEFAULT_CONTEXTS)
+			onion_layers.onion_unsafe(img, act_layer, inc,
+					Context(list(context), before.current_index), do_tint=do_tint)
+		elif kind == 1:
+			context = before.context
+			onion_layers.onion_unsafe(img, act_layer, inc, do_tint=do_tint)
+		else:
+			inc = 0
+			onion_layers.cycle_context(img, act_layer, do_tint=do_tint)
+			try:
+				n = DEFAULT_CONTEXTS.index(before.context)
+			except ValueError:
+				n = -1
+			context = DEFAULT_CONTEXTS[(n + 1) % len(DEFAULT_CONTEXTS)]
+
+		i = (before.current_index + inc) % N
+		self.check_invariants(img)
+		self.check_context(img, i, context)
+
+		# The active layer follows the current frame, if possible.
+		frame_layer = frames[i].layer
+		if hasattr(frame_layer, 'layers'):
+			n = onion_layers.sanitize_name(act_layer.name)
+			matching = [ layer for layer in frame_layer.layers
+					if onion_layers.sanitize_name(layer.name) == n ]
+			if matching:
+				self.assertIs(matching[0], img.active_layer)
+		else:
+			self.assertIs(frame_layer, img.active_layer)
+
+	def add_frame(self, img, rnd):
+		frames = list(get_frames(img))
+		i = self.get_current(img)
+
+		act_layer = self.get_sub_layer(frames[i].layer, rnd)
+		img.active_layer = act_layer
+
+		onion_layers.onion_add_frame(img, act_layer)
+		self.check_invariants(img)
+
+		new_frames = list(get_frames(img))
+		if len(new_frames) == len(frames):
+			return
+
+		self.assertEqual(len(frames) + 1, len(new_frames))
+
+		# New frame is inserted after the current one and becomes the
+		# current frame.
+		self.assertEqual(i, self.get_current(img))
+		self.assertIs(frames[i].layer, new_frames[i+1].layer)
+
+		num = NumberedName.from_layer_name(new_frames[i].layer.name).num
+		self.assertTrue(num > NumberedName.from_layer_name(frames[i].layer.name).num)
+		if i > 0:
+			self.assertTrue(num < NumberedName.from_layer_name(frames[i-1].layer.name).num)
+
+	def renumber(self, img, rnd):
+		names = [ layer.name for layer in img._walk() ]
+
+		onion_layers.onion_renumber_frames(img, img.active_layer)
+		self.check_invariants(img)
+
+		frames = list(get_frames(img))
+		nums = [ NumberedName.from_layer_name(frame.layer.name).num for frame in frames ]
+		self.assertEqual(sorted(nums, reverse=True), nums)
+
+		# Sub-layers are numbered the same as their frames.
+		for frame, num in zip(frames, nums):
+			if hasattr(frame.layer, 'layers'):
+				for layer in frame.layer.layers:
+					if frame.TINT_PREFIX in layer.name:
+						continue
+					self.assertEqual(num, NumberedName.from_layer_name(layer.name).num)
+
+		# Background layers are not renamed.
+		self.assertEqual(
+				[ name for name in names if name.startswith('[') ],
+				[ layer.name for layer in img._walk() if layer.name.startswith('[') ])
+
+	def test_random(self):
+		rnd = random.Random(42)
+
+		for seed in range(30):
+			img = self.make_image(rnd, rnd.randint(1, 12),
+					groups=None, backgrounds=rnd.randint(0, 2))
+
+			for n in range(30):
+				r = rnd.random()
+				if r < .8:
+					self.step(img, rnd)
+				elif r < .95:
+					self.add_frame(img, rnd)
+				else:
+					self.renumber(img, rnd)
+
+class TestOnionFast(FakeGimpTestCase):
+	def test_fast_then_full(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10)
+		act_layer = img.active_layer
+
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 9)
+		onion_layers.onion_unsafe(img, act_layer, 0, context, do_tint=True)
+		self.assertEqual(2, len(self.get_tint_layers(img)))
+
+		for n in range(3):
+			onion_layers.onion_unsafe(img, act_layer, -1, do_tint=True, fast=True)
+			self.check_invariants(img)
+
+			# Tints are hidden, active layer stays where it was.
+			self.assertFalse(any(layer.visible for layer in self.get_tint_layers(img)))
+			self.assertIs(act_layer, img.active_layer)
+
+		self.check_context(img, 6, context.context)
+
+		onion_layers.onion_unsafe(img, act_layer, 0, do_tint=True)
+		self.check_invariants(img)
+		self.check_context(img, 6, context.context)
+
+		frames = list(get_frames(img))
+		for layer in self.get_tint_layers(img):
+			self.assertTrue(layer.visible)
+			self.assertTrue(layer.parent in (frames[5].layer, frames[7].layer))
+
+		self.assertIs(frames[6].layer, img.active_layer.parent)
+
+class TestSubLayerPresets(FakeGimpTestCase):
+	def get_states(self, img, name):
+		states = []
+		for frame in get_frames(img):
+			for layer in frame.layer.layers:
+				if onion_layers.sanitize_name(layer.name) == name:
+					states.append((layer.visible, layer.opacity))
+		return states
+
+	def test_set_sub_layer(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 20, sub_layers=4)
+		frames = list(get_frames(img))
+
+		# one frame already has the desired state
+		layer = frames[3].layer.layers[0]
+		layer.visible = False
+		layer.opacity = 50.
+
+		self.reset_counters()
+		onion_layers.onion_set_sub_layer(img, img.active_layer, 'outline0100', False, 50)
+
+		self.assertEqual([ (False, 50.) ] * 20, self.get_states(img, 'outline'))
+		self.assertEqual(19*2, self.counters.writes)
+		self.assertEqual(0, img._undo_depth)
+
+	def test_presets(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 20, sub_layers=4)
+		frames = list(get_frames(img))
+
+		act_layer = frames[0].layer.layers[0]
+
+		onion_layers.onion_save_preset(img, act_layer, 'all')
+
+		act_layer.visible = False
+		onion_layers.onion_save_preset(img, act_layer, 'no-outline')
+
+		self.reset_counters()
+		onion_layers.onion_apply_preset(img, act_layer, 'no-outline')
+		self.assertEqual([ (False, 100.) ] * 20, self.get_states(img, 'outline'))
+
+		# 19 layers changed
+		self.assertEqual(19, self.counters.writes)
+
+		self.reset_counters()
+		onion_layers.onion_apply_preset(img, act_layer, 'all')
+		self.assertEqual([ (True, 100.) ] * 20, self.get_states(img, 'outline'))
+		self.assertEqual(20, self.counters.writes)
+
+		for name in self.SUB_LAYER_NAMES[1:]:
+			self.assertTrue(all(state == (True, 100.) for state in self.get_states(img, name)))
+
+		presets = onion_layers.SubLayerPresets.from_image(img)
+		self.assertEqual('all', presets.current)
+		self.assertEqual(set([ 'all', 'no-outline' ]), set(presets.presets.keys()))
+
+		# Changing layers by hand forgets the applied preset.
+		onion_layers.onion_set_sub_layer(img, act_layer, 'outline', False, 100)
+		self.assertEqual(None, onion_layers.SubLayerPresets.from_image(img).current)
+
+		onion_layers.onion_apply_preset(img, act_layer, 'all')
+		self.assertEqual([ (True, 100.) ] * 20, self.get_states(img, 'outline'))
+
+	def test_save_preset(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 3, sub_layers=4)
+		frames = list(get_frames(img))
+
+		act_layer = frames[0].layer.layers[0]
+		onion_layers.onion_save_preset(img, act_layer, 'all')
+
+		# Other frames don't match the saved preset, so applying it
+		# must touch them.
+		frames[1].layer.layers[0].visible = False
+		onion_layers.onion_save_preset(img, act_layer, 'all')
+		self.assertEqual(None, onion_layers.SubLayerPresets.from_image(img).current)
+
+		onion_layers.onion_apply_preset(img, act_layer, 'all')
+		self.assertEqual([ (True, 100.) ] * 3, self.get_states(img, 'outline'))
+
+	def test_copy_layer(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 5, sub_layers=4)
+		frames = list(get_frames(img))
+
+		sketch = frames[0].layer.layers[3]
+		color = frames[0].layer.layers[2]
+		sketch.visible = False
+		onion_layers.onion_save_preset(img, sketch, 'B')
+		color.visible = False
+		onion_layers.onion_save_preset(img, sketch, 'C')
+
+		onion_layers.onion_apply_preset(img, sketch, 'B')
+		self.assertEqual([ (False, 100.) ] * 5, self.get_states(img, 'sketch'))
+
+		# Copying a layer forgets the applied preset.
+		sketch.visible = True
+		onion_layers.onion_copy_layer(img, sketch)
+		self.assertEqual([ (True, 100.) ] * 5, self.get_states(img, 'sketch'))
+
+		onion_layers.onion_apply_preset(img, sketch, 'C')
+		self.assertEqual([ (False, 100.) ] * 5, self.get_states(img, 'sketch'))
+		self.assertEqual([ (False, 100.) ] * 5, self.get_states(img, 'color'))
+
+		# Undo must restore the applied preset together with the layers.
+		parasite = img.parasite_find(onion_layers.PRESETS_PARASITE)
+		self.assertTrue(parasite.flags & onion_layers.PARASITE_UNDOABLE)
+
+	def test_get_changes(self):
+		presets = onion_layers.SubLayerPresets({
+			'a': { 'outline': (True, 100.), 'sketch': (True, 50.) },
+			'b': { 'outline': (True, 100.), 'sketch': (False, 50.) },
+		}, 'a')
+
+		self.assertEqual({ 'sketch': (False, 50.) }, presets.get_changes('b'))
+		self.assertEqual(presets.presets['a'], presets.get_changes('a'))
+
+		presets.current = None
+		self.assertEqual(presets.presets['b'], presets.get_changes('b'))
+
+	def test_missing_preset(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 3, sub_layers=4)
+
+		onion_layers.onion_apply_preset(img, img.active_layer, 'foo')
+		self.assertEqual(1, len(self.pdb.messages))
+
+class TestSortFrames(FakeGimpTestCase):
+	def test_sort(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 50, groups=None, backgrounds=3, sub_layers=4)
+
+		backgrounds = [ (n, layer) for n, layer in enumerate(img.layers)
+				if layer.name.startswith('[') ]
+		expected = [ frame.layer for frame in get_frames(img) ]
+
+		# swap two frames
+		layers = img._layers
+		a = layers.index(expected[10])
+		b = layers.index(expected[20])
+		layers[a], layers[b] = layers[b], layers[a]
+
+		self.reset_counters()
+		onion_layers.onion_sort_frames(img, img.active_layer)
+
+		self.assertEqual(expected, [ frame.layer for frame in get_frames(img) ])
+		self.assertEqual(backgrounds, [ (n, layer) for n, layer in enumerate(img.layers)
+				if layer.name.startswith('[') ])
+		self.assertEqual(2, self.counters.pdb_calls)
+		self.assertEqual(0, img._undo_depth)
+
+class TestContextLayers(FakeGimpTestCase):
+	def get_visible(self, frame):
+		return [ onion_layers.sanitize_name(layer.name) for layer in frame.layer.layers
+				if layer.visible and not layer.name.startswith(Frame.TINT_PREFIX) ]
+
+	def test_context_layers(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10, sub_layers=4)
+		for layer in img._walk():
+			if hasattr(layer, '_layers'):
+				self.assertEqual(self.SUB_LAYER_NAMES, self.get_visible(Frame(layer)))
+
+		frames = list(get_frames(img))
+
+		# hidden by the user - this must stay hidden
+		sketch = frames[7].layer.layers[3]
+		sketch.visible = False
+
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 9)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context, do_tint=True)
+
+		onion_layers.onion_set_context_layers(img, img.active_layer, "outline0100, color")
+		self.check_invariants(img)
+		self.assertEqual(0, img._undo_depth)
+
+		all_names = self.SUB_LAYER_NAMES
+		context_names = [ 'outline', 'color' ]
+
+		self.assertEqual(all_names, self.get_visible(frames[9]))
+		self.assertEqual(context_names, self.get_visible(frames[8]))
+		self.assertEqual(context_names, self.get_visible(frames[0]))
+
+		# Undoing a step must also undo the markers, which go along
+		# with undoable visibility changes.
+		for parasite in [ img.parasite_find(onion_layers.CONTEXT_LAYERS_PARASITE),
+				frames[8].layer.layers[-3].parasite_find(onion_layers.CONTEXT_HIDDEN_PARASITE) ]:
+			self.assertTrue(parasite.flags & onion_layers.PARASITE_UNDOABLE)
+
+		for n in range(3):
+			onion_layers.onion_unsafe(img, img.active_layer, -1, do_tint=True)
+			self.check_invariants(img)
+
+		self.check_context(img, 6, context.context)
+
+		# Frames that were hidden while a neighbor are shown again.
+		self.assertEqual(all_names, self.get_visible(frames[6]))
+		self.assertEqual(context_names, self.get_visible(frames[5]))
+		self.assertEqual(context_names, self.get_visible(frames[7]))
+		self.assertEqual(context_names, self.get_visible(frames[8]))
+
+		# Filter layers don't change the content hash.
+		self.assertEqual(frames[5].get_content_hash(), frames[4].get_content_hash())
+
+		onion_layers.onion_unsafe(img, img.active_layer, 1, do_tint=True)
+		self.assertEqual(all_names[:3], self.get_visible(frames[7]))
+		self.assertFalse(sketch.visible)
+
+		onion_layers.onion_set_context_layers(img, img.active_layer, "")
+		self.assertIsNone(img.parasite_find(onion_layers.CONTEXT_LAYERS_PARASITE))
+		for frame in frames:
+			if frame.layer is not frames[7].layer:
+				self.assertEqual(all_names, self.get_visible(frame))
+			for layer in frame.layer.layers:
+				self.assertFalse(onion_layers.is_context_hidden(layer))
+
+	def test_set_by_hand(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10, sub_layers=4)
+		frames = list(get_frames(img))
+
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 9)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context)
+		onion_layers.onion_set_context_layers(img, img.active_layer, "outline")
+
+		# Layers hidden or shown by hand are no longer marked.
+		onion_layers.onion_set_sub_layer(img, img.active_layer, 'shading', False, 100)
+		onion_layers.onion_copy_layer(img, frames[9].layer.layers[2])
+		for frame in frames:
+			for layer in frame.layer.layers[1:3]:
+				self.assertFalse(onion_layers.is_context_hidden(layer))
+
+		self.assertEqual([ 'outline', 'color' ], self.get_visible(frames[8]))
+
+		# Stepping doesn't show the hidden layer again.
+		onion_layers.onion_unsafe(img, img.active_layer, -1)
+		self.check_context(img, 8, context.context)
+		self.assertEqual([ 'outline', 'color', 'sketch' ], self.get_visible(frames[8]))
+
+	def test_show_all(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10, sub_layers=4)
+
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 9)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context)
+		onion_layers.onion_set_context_layers(img, img.active_layer, "outline")
+
+		onion_layers.show_all(img, img.active_layer)
+
+		for frame in get_frames(img):
+			self.assertEqual(self.SUB_LAYER_NAMES, self.get_visible(frame))
+
+class TestPaging(FakeGimpTestCase):
+	def setUp(self):
+		FakeGimpTestCase.setUp(self)
+		self.path = tempfile.mkdtemp()
+		self.old_page_dir = onion_layers.PAGE_DIR
+		onion_layers.PAGE_DIR = self.path
+
+	def tearDown(self):
+		onion_layers.PAGE_DIR = self.old_page_dir
+		shutil.rmtree(self.path)
+		FakeGimpTestCase.tearDown(self)
+
+	def make_paged_image(self, nframes):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, nframes, sub_layers=4)
+
+		for n, layer in enumerate(img._walk()):
+			if not hasattr(layer, '_layers'):
+				layer._pixels = ("%d" % (n,)).encode('ascii') * 10
+				layer._set('offsets', (n, 2*n))
+
+		return img
+
+	def get_contents(self, img):
+		return [ (layer.name, layer._pixels, layer.offsets, layer.visible)
+				for layer in img._walk() ]
+
+	def is_paged(self, frame):
+		return frame.layer.parasite_find(onion_layers.PAGED_PARASITE) is not None
+
+	def test_page_file(self):
+		path = self.path + '/test.page'
+		infos = [ { 'name': 'a', 'mask': False }, { 'name': 'b', 'mask': True } ]
+		blobs = [ b'1234', b'', b'\x00' * 100 ]
+
+		onion_layers.write_page(path, infos, blobs)
+		self.assertEqual((infos, blobs), onion_layers.read_page(path))
+
+	def test_paging(self):
+		img = self.make_paged_image(40)
+		contents = self.get_contents(img)
+
+		frames = list(get_frames(img))
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 39)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context)
+
+		onion_layers.onion_enable_paging(img, img.active_layer, 5)
+		self.assertEqual(0, img._undo_depth)
+
+		paged = [ n for n, frame in enumerate(frames) if self.is_paged(frame) ]
+		self.assertEqual(list(range(5, 34)), paged)
+		for n in paged:
+			self.assertEqual([], frames[n].layer.layers)
+
+		# Step through all frames twice.
+		for n in range(80):
+			onion_layers.onion_unsafe(img, img.active_layer, -1)
+			self.check_invariants(img)
+
+			i = self.get_current(img)
+			# current, context and prefetch in the direction of travel
+			for k in range(i - 2, i + 2):
+				self.assertFalse(self.is_paged(frames[k % 40]))
+
+			self.assertEqual(len(self.SUB_LAYER_NAMES), len(frames[i].layer.layers))
+			self.assertIs(frames[i].layer, img.active_layer.parent)
+
+			paged = [ frame for frame in frames if self.is_paged(frame) ]
+			self.assertTrue(len(paged) >= 40 - 2*5 - 1 - 2)
+
+		pager = onion_layers.Pager.from_image(img)
+		onion_layers.onion_disable_paging(img, img.active_layer)
+		self.assertIsNone(img.parasite_find(onion_layers.PAGING_PARASITE))
+
+		# Each frame was paged out twice without changes. Page files
+		# are kept, since other images might refer to them.
+		self.assertTrue(0 < len(os.listdir(pager.get_dir())) <= 40)
+
+		# Frame visibility changed, but contents of all layers are the same.
+		self.assertEqual(
+				[ (name, pixels, offsets) for name, pixels, offsets, visible in contents ],
+				[ (name, pixels, offsets) for name, pixels, offsets, visible in self.get_contents(img) ])
+
+	def test_properties(self):
+		img = self.make_paged_image(20)
+		frames = list(get_frames(img))
+
+		layer = frames[10].layer.layers[1]
+		layer.lock_alpha = True
+		layer.linked = True
+		layer._lock_content = True
+		layer._lock_position = True
+		layer._color_tag = 3
+		layer.attach_new_parasite('foo', 1, 'bar')
+		layer.add_mask(layer.create_mask(0))
+		layer.mask._pixels = b'mask'
+		layer.show_mask = True
+		layer.apply_mask = False
+
+		onion_layers.onion_enable_paging(img, img.active_layer, 3)
+		self.assertTrue(self.is_paged(frames[10]))
+
+		onion_layers.onion_disable_paging(img, img.active_layer)
+
+		layer = frames[10].layer.layers[1]
+		self.assertEqual((True, True, True, True, 3),
+				(layer.lock_alpha, layer.linked, layer._lock_content,
+					layer._lock_position, layer._color_tag))
+		self.assertEqual(b'bar', onion_layers._to_bytes(layer.parasite_find('foo').data))
+		self.assertEqual(b'mask', layer.mask._pixels)
+		self.assertEqual((False, True, False),
+				(layer.apply_mask, layer.show_mask, layer.edit_mask))
+
+	def test_fast(self):
+		img = self.make_paged_image(20)
+		frames = list(get_frames(img))
+
+		onion_layers.onion_enable_paging(img, img.active_layer, 3)
+		paged = [ self.is_paged(frame) for frame in frames ]
+
+		# Paging waits for the full update.
+		onion_layers.onion_unsafe(img, img.active_layer, 10, fast=True)
+		self.assertEqual(paged, [ self.is_paged(frame) for frame in frames ])
+
+		onion_layers.onion_unsafe(img, img.active_layer, 0)
+		self.assertFalse(self.is_paged(frames[self.get_current(img)]))
+
+	def test_renumber(self):
+		img = self.make_paged_image(20)
+		frames = list(get_frames(img))
+
+		onion_layers.onion_enable_paging(img, img.active_layer, 3)
+		self.assertTrue(self.is_paged(frames[10]))
+
+		onion_layers.onion_renumber_frames(img, img.active_layer)
+		onion_layers.onion_disable_paging(img, img.active_layer)
+
+		names = [ layer.name for layer in img._walk() ]
+		self.assertEqual(len(names), len(set(names)))
+
+		for frame in frames:
+			self.assertFalse(self.is_paged(frame))
+			num = NumberedName.from_layer_name(frame.layer.name).num
+			for layer in frame.layer.layers:
+				self.assertEqual(num, NumberedName.from_layer_name(layer.name).num)
+
+	def test_page_out_again(self):
+		img = self.make_paged_image(20)
+		frames = list(get_frames(img))
+
+		onion_layers.onion_enable_paging(img, img.active_layer, 3)
+		paged = [ self.is_paged(frame) for frame in frames ]
+		self.assertTrue(any(paged))
+
+		# Functions that work on all frames page far frames out again
+		# when they finish.
+		for func, args in [
+				(onion_layers.onion_set_sub_layer, ('outline', True, 100)),
+				(onion_layers.onion_copy_layer, ()),
+				(onion_layers.onion_find_duplicates, ()),
+				(onion_layers.onion_expand_holds, ()),
+				(onion_layers.onion_set_context_layers, ("",)),
+				(onion_layers.show_all, ()) ]:
+			func(img, img.active_layer, *args)
+			self.assertEqual(paged, [ self.is_paged(frame) for frame in frames ])
+			self.assertEqual(0, img._undo_depth)
+
+class TestCostReport(FakeGimpTestCase):
+	def test_report(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 5, backgrounds=1, sub_layers=4)
+		frames = list(get_frames(img))
+
+		# one small layer and one mostly empty full-canvas layer
+		small = frames[0].layer.layers[0]
+		small._set('width', 10)
+		small._set('height', 10)
+		small._set('offsets', (5, 5))
+
+		empty = frames[1].layer.layers[0]
+		empty._set('_coverage', 0.01)
+
+		onion_layers.onion_unsafe(img, img.active_layer, 0,
+				Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 4), do_tint=True)
+
+		report = onion_layers.make_cost_report(img)
+
+		self.assertEqual(onion_layers.REPORT_FORMAT, report['format'])
+		self.assertEqual([ empty.name ], report['mostly_empty'])
+		self.assertEqual(5, len(report['frames']))
+		self.assertEqual(1, len(report['backgrounds']))
+
+		full = 64*64*4
+		self.assertEqual(full*4 + 10*10*4, report['sub_layers']['outline'])
+		self.assertEqual(full, report['sub_layers'][Frame.TINT_PREFIX + 'after'])
+
+		total = sum(layer.width * layer.height * layer.bpp for layer in img._walk())
+		self.assertEqual(total, report['bytes'])
+
+		# background, current frame and both neighbours with their tint layers
+		self.assertEqual(frames[4].layer.name, report['compositing']['current_frame'])
+
+		visible = [ layer for layer in img._walk()
+				if layer.visible and (layer.parent is None or layer.parent.visible) ]
+		self.assertEqual(1 + 3*1 + len(frames[4].layer.layers) +
+				len(frames[3].layer.layers) + len(frames[0].layer.layers),
+				report['compositing']['layers'])
+		self.assertEqual(len(visible), report['compositing']['layers'])
+
+		# report must be serializable
+		onion_layers.json.dumps(report)
+
+class TestExpandHolds(FakeGimpTestCase):
+	def test_hash_bare_frames(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 4, groups=False)
+
+		# Onion state doesn't change the content hash.
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 1)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context)
+
+		frames, runs = onion_layers.find_duplicate_frames(img)
+		self.assertEqual([ (0, 3) ], runs)
+
+	def test_collapse(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 6, sub_layers=4)
+
+		frames = list(get_frames(img))
+		for n in (0, 4, 5):
+			for layer in frames[n].layer.layers:
+				layer._pixels = layer.name.encode('ascii')
+
+		# The current frame is removed.
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 2)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context, do_tint=True)
+
+		onion_layers.onion_collapse_duplicates(img, img.active_layer)
+		self.check_invariants(img)
+		self.check_context(img, 1, context.context)
+
+		frames = list(get_frames(img))
+		self.assertEqual(4, len(frames))
+		self.assertEqual(3, frames[1].get_hold())
+
+		# Undo must restore the hold together with the removed frames.
+		parasite = frames[1].layer.parasite_find(onion_layers.HOLD_PARASITE)
+		self.assertTrue(parasite.flags & onion_layers.PARASITE_UNDOABLE)
+
+	def test_expand(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 5, sub_layers=4)
+
+		frames = list(get_frames(img))
+		frames[1].layer._set('name', 'extra')
+		frames[2].set_hold(3)
+
+		# Frame 200 is tinted as the frame after the current one.
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 3)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context)
+		ntints = len(self.get_tint_layers(img))
+
+		onion_layers.onion_expand_holds(img, img.active_layer)
+		self.check_invariants(img)
+
+		# Copies are numbered below the next numbered frame.
+		self.assertEqual([ 400, None, 333, 266, 200, 100, 0 ],
+				[ NumberedName.from_layer_name(frame.layer.name).num
+					for frame in get_frames(img) ])
+
+		# Copies don't carry tint layers.
+		self.assertEqual(ntints, len(self.get_tint_layers(img)))
+
+		for frame in get_frames(img):
+			self.assertEqual(1, frame.get_hold())
+
+class TestFrameRanges(FakeGimpTestCase):
+	def get_nums(self, img):
+		return [ NumberedName.from_layer_name(frame.layer.name).num
+				for frame in get_frames(img) ]
+
+	def check_names(self, img):
+		names = [ layer.name for layer in img._walk() ]
+		self.assertEqual(len(names), len(set(names)))
+
+		for frame in get_frames(img):
+			num = NumberedName.from_layer_name(frame.layer.name).num
+			for layer in frame.layer.layers:
+				self.assertEqual(num, NumberedName.from_layer_name(layer.name).num)
+
+	def test_duplicate(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10, sub_layers=4)
+		for layer in img._walk():
+			layer._pixels = layer.name.encode('ascii')
+
+		self.reset_counters()
+		onion_layers.onion_duplicate_frames(img, img.active_layer, 200, 400, True)
+		self.check_invariants(img)
+		self.check_names(img)
+
+		self.assertEqual([ 900, 800, 700, 600, 500, 475, 450, 425, 400, 300, 200, 100, 0 ],
+				self.get_nums(img))
+
+		frames = list(get_frames(img))
+		for n, m in [ (5, 8), (6, 9), (7, 10) ]:
+			self.assertEqual(
+					[ layer._pixels for layer in frames[n].layer.layers ],
+					[ layer._pixels for layer in frames[m].layer.layers ])
+
+		# Work done is proportional to the range: a copy and a marker
+		# lookup per sub-layer for each frame, plus the paging check.
+		self.assertEqual(1 + 3*(1 + 4) + 1, self.counters.pdb_calls)
+
+	def test_duplicate_holds(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 5, sub_layers=4)
+
+		frames = list(get_frames(img))
+		frames[3].set_hold(3)
+
+		# Duplicates are held for as long as the originals.
+		for copy_pixels in (True, False):
+			onion_layers.onion_duplicate_frames(img, img.active_layer, 100, 200, copy_pixels)
+
+		self.assertEqual([ 400, 300, 266, 233, 222, 211, 200, 100, 0 ], self.get_nums(img))
+		self.assertEqual([ 1, 1, 1, 3, 1, 3, 1, 3, 1 ],
+				[ frame.get_hold() for frame in get_frames(img) ])
+
+	def test_duplicate_clean(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 5, sub_layers=4)
+
+		frames = list(get_frames(img))
+		frames[1].layer._set('name', 'extra')
+
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 3)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context, do_tint=True)
+		onion_layers.onion_set_context_layers(img, img.active_layer, "outline")
+		ntints = len(self.get_tint_layers(img))
+
+		onion_layers.onion_duplicate_frames(img, img.active_layer, 100, 200, True)
+		self.check_invariants(img)
+
+		# Copies go below the next numbered frame.
+		self.assertEqual([ 400, None, 333, 266, 200, 100, 0 ], self.get_nums(img))
+
+		# Copies have neither tint layers nor hidden sub-layers.
+		self.assertEqual(ntints, len(self.get_tint_layers(img)))
+		for frame in list(get_frames(img))[2:4]:
+			for layer in frame.layer.layers:
+				self.assertTrue(layer.visible)
+				self.assertFalse(onion_layers.is_context_hidden(layer))
+
+	def test_duplicate_blank(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 3, sub_layers=4)
+
+		onion_layers.onion_duplicate_frames(img, img.active_layer, 0, 200, False)
+		self.check_invariants(img)
+		self.check_names(img)
+
+		self.assertEqual([ 500, 400, 300, 200, 100, 0 ], self.get_nums(img))
+
+	def test_duplicate_no_space(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 3, sub_layers=4)
+		for layer in img._walk():
+			layer._set('name', layer.name.replace('00', '', 1))
+
+		onion_layers.onion_duplicate_frames(img, img.active_layer, 0, 1, True)
+		self.assertEqual(1, len(self.pdb.messages))
+		self.assertEqual(3, len(list(get_frames(img))))
+
+	def test_delete(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10, sub_layers=4)
+
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 5)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context)
+
+		onion_layers.onion_delete_frames(img, img.active_layer, 300, 500)
+		self.check_invariants(img)
+
+		self.assertEqual([ 900, 800, 700, 600, 200, 100, 0 ], self.get_nums(img))
+		self.check_context(img, 4, context.context)
+
+		onion_layers.onion_delete_frames(img, img.active_layer, 700, 800)
+		self.assertEqual([ 900, 600, 200, 100, 0 ], self.get_nums(img))
+		self.check_context(img, 2, context.context)
+
+	def test_shift(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10, sub_layers=4)
+
+		onion_layers.onion_shift_frames(img, img.active_layer, 300, 500, 50)
+		self.check_invariants(img)
+		self.check_names(img)
+		self.assertEqual([ 900, 800, 700, 600, 550, 450, 350, 200, 100, 0 ], self.get_nums(img))
+
+		onion_layers.onion_shift_frames(img, img.active_layer, 350, 550, -149)
+		self.check_invariants(img)
+		self.check_names(img)
+		self.assertEqual([ 900, 800, 700, 600, 401, 301, 201, 200, 100, 0 ], self.get_nums(img))
+
+	def test_shift_passing(self):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, 10, sub_layers=4)
+
+		onion_layers.onion_shift_frames(img, img.active_layer, 300, 500, 100)
+		onion_layers.onion_shift_frames(img, img.active_layer, 300, 500, -100)
+		onion_layers.onion_shift_frames(img, img.active_layer, 0, 100, -1)
+
+		self.assertEqual(3, len(self.pdb.messages))
+		self.assertEqual(list(range(900, -1, -100)), self.get_nums(img))
+
+		# Unnumbered frames don't count as neighbors.
+		frames = list(get_frames(img))
+		frames[4].layer._set('name', 'extra')
+		frames[6].layer._set('name', 'more')
+		onion_layers.onion_shift_frames(img, img.active_layer, 400, 400, 250)
+		onion_layers.onion_shift_frames(img, img.active_layer, 400, 400, -250)
+
+		self.assertEqual(5, len(self.pdb.messages))
+
+class TestSpliceFrames(FakeGimpTestCase):
+	def make_images(self, nframes, nsrc_frames):
+		rnd = random.Random(1)
+
+		img = self.make_image(rnd, nframes, sub_layers=4)
+		src_img = self.make_image(rnd, nsrc_frames, sub_layers=4)
+
+		for layer in src_img._walk():
+			layer._pixels = ("src-" + layer.name).encode('ascii')
+
+		return img, src_img
+
+	def get_nums(self, img):
+		return [ NumberedName.from_layer_name(frame.layer.name).num
+				for frame in get_frames(img) ]
+
+	def check_frames(self, img):
+		self.check_invariants(img)
+
+		nums = self.get_nums(img)
+		self.assertEqual(sorted(set(nums), reverse=True), nums)
+
+		for frame, num in zip(get_frames(img), nums):
+			for layer in frame.layer.layers:
+				self.assertEqual(num, NumberedName.from_layer_name(layer.name).num)
+
+	def set_current(self, img, i):
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], i)
+		onion_layers.onion_unsafe(img, img.active_layer, 0, context)
+		img.active_layer = list(get_frames(img))[i].layer.layers[0]
+
+	def test_splice_in_gap(self):
+		img, src_img = self.make_images(10, 20)
+		self.set_current(img, 5)
+
+		onion_layers.onion_splice_frames(img, img.active_layer, src_img, 500, 700)
+		self.check_frames(img)
+
+		self.assertEqual([ 900, 800, 700, 600, 500, 475, 450, 425, 400, 300, 200, 100, 0 ],
+				self.get_nums(img))
+
+		# Current frame stays the same.
+		self.assertEqual(8, self.get_current(img))
+
+		frames = list(get_frames(img))
+		self.assertEqual([ b"src-outline0700", b"src-shading0700", b"src-color0700", b"src-sketch0700" ],
+				[ layer._pixels for layer in frames[5].layer.layers ])
+		self.assertEqual(b"src-outline0500", frames[7].layer.layers[0]._pixels)
+
+	def test_splice_local_renumber(self):
+		img, src_img = self.make_images(10, 20)
+
+		# Frames 400, 410, 420, 430 leave no space after 400.
+		for layer in img._walk():
+			nn = NumberedName.from_layer_name(layer.name)
+			if nn.num in (500, 600, 700):
+				nn.num = 400 + (nn.num - 400) // 10
+				layer._set('name', nn.to_string())
+
+		self.set_current(img, 5)
+		self.assertEqual([ 900, 800, 430, 420, 410, 400, 300, 200, 100, 0 ], self.get_nums(img))
+
+		self.reset_counters()
+		onion_layers.onion_splice_frames(img, img.active_layer, src_img, 0, 1900)
+		self.check_frames(img)
+
+		nums = self.get_nums(img)
+		self.assertEqual(30, len(nums))
+		self.assertEqual([ 900, 800 ], nums[:2])
+		self.assertEqual([ 400, 300, 200, 100, 0 ], nums[-5:])
+
+		self.assertEqual(25, self.get_current(img))
+
+		# One copy per frame, no per-layer copies or lookups.
+		self.assertTrue(self.counters.pdb_calls <= 20*2 + 8)
+
+	def test_splice_after_last(self):
+		img, src_img = self.make_images(3, 5)
+		self.set_current(img, 0)
+
+		onion_layers.onion_splice_frames(img, img.active_layer, src_img, 100, 200)
+		self.check_frames(img)
+
+		self.assertEqual([ 400, 300, 200, 100, 0 ], self.get_nums(img))
+
+	def test_splice_unnumbered(self):
+		img, src_img = self.make_images(10, 20)
+
+		for layer in img._walk():
+			nn = NumberedName.from_layer_name(layer.name)
+			if nn.num == 600:
+				nn.num = 401
+				layer._set('name', nn.to_string())
+		frames = list(get_frames(img))
+		frames[4].layer._set('name', 'extra')
+
+		self.set_current(img, 5)
+		onion_layers.onion_splice_frames(img, img.active_layer, src_img, 0, 200)
+		self.check_invariants(img)
+
+		# The frame after the unnumbered one makes room.
+		self.assertEqual([ 900, 800, 700, 640, None, 580, 520, 460, 400, 300, 200, 100, 0 ],
+				self.get_nums(img))
+
+	def test_splice_clean(self):
+		img, src_img = self.make_images(5, 5)
+		self.set_current(img, 2)
+
+		# Source frames have tint layers, hidden sub-layers and holds.
+		context = Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 2)
+		onion_layers.onion_unsafe(src_img, src_img.active_layer, 0, context, do_tint=True)
+		onion_layers.onion_set_context_layers(src_img, src_img.active_layer, "outline")
+		src_frames = list(get_frames(src_img))
+		src_frames[1].set_hold(2)
+
+		ntints = len(self.get_tint_layers(img))
+		onion_layers.onion_splice_frames(img, img.active_layer, src_img, 100, 300)
+		self.check_frames(img)
+
+		self.assertEqual(ntints, len(self.get_tint_layers(img)))
+
+		# Holds are kept.
+		frames = list(get_frames(img))
+		self.assertEqual([ 2, 1, 1 ], [ frame.get_hold() for frame in frames[2:5] ])
+
+		for frame in frames[2:5]:
+			self.assertEqual(4, len(frame.layer.layers))
+			for layer in frame.layer.layers:
+				self.assertTrue(layer.visible)
+				self.assertFalse(onion_layers.is_context_hidden(layer))
+
+	def test_splice_paged(self):
+		img, src_img = self.make_images(5, 20)
+		self.set_current(img, 2)
+
+		path = tempfile.mkdtemp()
+		old_page_dir = onion_layers.PAGE_DIR
+		onion_layers.PAGE_DIR = path
+		try:
+			onion_layers.onion_enable_paging(src_img, src_img.active_layer, 3)
+
+			undo_groups = []
+			src_img.undo_group_start = lambda: undo_groups.append(src_img._undo_depth)
+			src_img.undo_group_end = lambda: undo_groups.append(None)
+
+			onion_layers.onion_splice_frames(img, img.active_layer, src_img, 900, 1100)
+		finally:
+			onion_layers.PAGE_DIR = old_page_dir
+			shutil.rmtree(path)
+
+		self.check_frames(img)
+
+		# Source frames were paged in within an undo group.
+		self.assertEqual([ 0, None ], undo_groups)
+
+		frames = list(get_frames(img))
+		self.assertEqual([ b"src-outline1100", b"src-shading1100", b"src-color1100", b"src-sketch1100" ],
+				[ layer._pixels for layer in frames[2].layer.layers ])
+
+	def test_move_frame_numbers(self):
+		rnd = random.Random(1)
+
+		for n in range(100):
+			N = rnd.randint(1, 10)
+			old = sorted(rnd.sample(range(30), N))
+			new = sorted(rnd.sample(range(30), N))
+
+			# Which frame currently has each number. A frame may
+			# only take a number that no other frame has.
+			taken = dict((num, k) for k, num in enumerate(old))
+			test = self
+
+			class Layer(object):
+				def __init__(self, k):
+					self.k = k
+					self._name = "frame%04d" % (old[k],)
+
+				@property
+				def name(self):
+					return self._name
+
+				@name.setter
+				def name(self, name):
+					num = NumberedName.from_layer_name(name).num
+					test.assertTrue(taken.get(num, self.k) == self.k)
+
+					del taken[NumberedName.from_layer_name(self._name).num]
+					taken[num] = self.k
+					self._name = name
+
+			layers = [ Layer(k) for k in range(N) ]
+
+			onion_layers.move_frame_numbers([ (layers[k], old[k], new[k]) for k in range(N) ])
+
+			self.assertEqual(new, [ NumberedName.from_layer_name(layer.name).num
+					for layer in layers ])
+
+class TestOnionBudget(FakeGimpTestCase):
+	# Work done by a single step must not grow with the number of frames.
+	SIZES = [ 8, 64, 512 ]
+
+	def measure(self, nframes, func, do_tint=True):
+		rnd = random.Random(1)
+		img = self.make_image(rnd, nframes)
+
+		# settle into a steady state first
+		for inc in [ 1, 1, 1 ]:
+			onion_layers.onion_unsafe(img, img.active_layer, inc,
+					Context([ NEXT_PREV_OPACITY, 100., NEXT_PREV_OPACITY ], 0),
+					do_tint=do_tint)
+			onion_layers.onion_unsafe(img, img.active_layer, 0, do_tint=do_tint)
+
+		self.reset_counters()
+		func(img)
+		self.check_invariants(img)
+
+		return self.counters.pdb_calls, self.counters.writes
+
+	def assertConstant(self, func, max_pdb_calls, max_writes, **kwargs):
+		results = [ self.measure(n, func, **kwargs) for n in self.SIZES ]
+
+		for pdb_calls, writes in results:
+			self.assertTrue(pdb_calls <= max_pdb_calls, results)
+			self.assertTrue(writes <= max_writes, results)
+
+	def test_step(self):
+		self.assertConstant(
+			lambda img: onion_layers.onion_unsafe(img, img.active_layer, 1, do_tint=False),
+			max_pdb_calls=4, max_writes=8, do_tint=False)
+
+	def test_step_tint(self):
+		self.assertConstant(
+			lambda img: onion_layers.onion_unsafe(img, img.active_layer, 1, do_tint=True),
+			max_pdb_calls=8, max_writes=12)
+
+	def test_cycle_context(self):
+		self.assertConstant(
+			lambda img: onion_layers.cycle_context(img, img.active_layer, do_tint=True),
+			max_pdb_calls=8, max_writes=12)
+
+	def test_add_frame(self):
+		self.assertConstant(
+			lambda img: onion_layers.onion_add_frame(img, img.active_layer),
+			max_pdb_calls=20, max_writes=20)
+
+	def test_step_fast(self):
+		self.assertConstant(
+			lambda img: onion_layers.onion_unsafe(img, img.active_layer, 1, do_tint=True, fast=True),
+			max_pdb_calls=2, max_writes=8)
+
+	def test_renumber(self):
+		for nframes in self.SIZES:
+			rnd = random.Random(1)
+			img = self.make_image(rnd, nframes)
+			nitems = len(list(img._walk()))
+
+			self.reset_counters()
+			onion_layers.onion_renumber_frames(img, img.active_layer)
+			self.check_invariants(img)
+
+			# two passes over all numbered layers
+			self.assertEqual(0, self.counters.pdb_calls)
+			self.assertTrue(self.counters.writes <= 2*nitems)
 
 class TestNumberedName(unittest.TestCase):
 	def test_parse(self):
@@ -29,6 +1483,47 @@ class TestNumberedName(unittest.TestCase):
 
 		self.assertEqual(s, "foo")
 
+	def test_parse_mask(self):
+
+		nn = NumberedName.from_layer_name("outline0100 mask")
+
+		self.assertEqual(nn.name, "outline")
+		self.assertEqual(nn.num, 100)
+		self.assertEqual(nn.is_mask, True)
+		self.assertEqual(nn.width, 4)
+
+		self.assertEqual(nn.to_string(), "outline0100")
+
+	def test_parse_odd(self):
+		cases = [
+			("", ("", None, None, False)),
+			("0100", ("", 100, 4, False)),
+			(" mask", ("", None, None, True)),
+			("mask", ("mask", None, None, False)),
+			("foo mask mask", ("foo mask", None, None, True)),
+			("frame 12 mask", ("frame ", 12, 2, True)),
+			("12 copy", ("12 copy", None, None, False)),
+			("a1b2", ("a1b", 2, 1, False)),
+		]
+
+		for name, expected in cases:
+			nn = NumberedName.from_layer_name(name)
+			self.assertEqual(expected, (nn.name, nn.num, nn.width, nn.is_mask), name)
+
+	def test_cache(self):
+		nn = NumberedName.from_layer_name("outline0100")
+		nn.num = 200
+
+		# Modifying a parsed name must not affect later results.
+		nn = NumberedName.from_layer_name("outline0100")
+		self.assertEqual(100, nn.num)
+
+	def test_cache_size(self):
+		for n in range(NumberedName.CACHE_SIZE * 2):
+			NumberedName.from_layer_name("frame%d" % (n,))
+
+		self.assertTrue(len(NumberedName._cache) <= NumberedName.CACHE_SIZE)
+
 class TestGetMiddleNumber(unittest.TestCase):
 	def test_basic(self):
 		self.assertEqual(50, get_middle_number(0, 100))
@@ -60,6 +1555,200 @@ class TestGetMiddleNumber(unittest.TestCase):
 		for n in range(100):
 			self.assertEqual(n+1, get_middle_number(n, n+2))
 
+class TestFindIdenticalRuns(unittest.TestCase):
+	def test_basic(self):
+		self.assertEqual([], find_identical_runs([]))
+		self.assertEqual([], find_identical_runs(['a']))
+		self.assertEqual([], find_identical_runs(['a', 'b', 'a']))
+
+		self.assertEqual([(0, 1)], find_identical_runs(['a', 'a', 'b']))
+		self.assertEqual([(1, 3)], find_identical_runs(['b', 'a', 'a', 'a']))
+		self.assertEqual([(0, 1), (2, 4)],
+				find_identical_runs(['a', 'a', 'b', 'b', 'b', 'c']))
+
+class TestSpreadNumbers(unittest.TestCase):
+	def test_basic(self):
+		self.assertEqual([50], spread_numbers(0, 100, 1))
+		self.assertEqual([25, 50, 75], spread_numbers(0, 100, 3))
+		self.assertEqual([1, 2], spread_numbers(0, 3, 2))
+
+		with self.assertRaises(ValueError):
+			spread_numbers(0, 3, 3)
+
+	def test_last(self):
+		self.assertEqual([200, 300], spread_numbers(100, None, 2, 100))
+
+	def test_unique(self):
+		for k in range(1, 10):
+			for b in range(k + 1, 30):
+				nums = spread_numbers(0, b, k)
+				self.assertEqual(k, len(set(nums)))
+				self.assertEqual(sorted(nums), nums)
+				self.assertTrue(0 < nums[0])
+				self.assertTrue(nums[-1] < b)
+
+class TestLatencyBudget(unittest.TestCase):
+	def test_first_step(self):
+		budget = LatencyBudget()
+		self.assertFalse(budget.is_over_budget(100.))
+
+	def test_slow_steps(self):
+		budget = LatencyBudget()
+		budget.record_step(100., False, LATENCY_BUDGET * 4)
+		self.assertTrue(budget.is_over_budget(200.))
+
+		# Budget recovers once full steps get fast again.
+		for n in range(10):
+			budget.record_full(LATENCY_BUDGET / 4)
+		self.assertFalse(budget.is_over_budget(300.))
+
+	def test_fast_keys(self):
+		budget = LatencyBudget()
+		budget.record_step(100., False, LATENCY_BUDGET / 2)
+
+		self.assertTrue(budget.is_over_budget(100. + LATENCY_BUDGET / 4))
+		self.assertFalse(budget.is_over_budget(100. + LATENCY_BUDGET))
+
+	def test_fast_step_does_not_count(self):
+		budget = LatencyBudget()
+		budget.record_step(100., False, 0.1)
+		budget.record_step(101., True, 0.01)
+
+		self.assertEqual(0.05, budget.full_duration)
+		self.assertEqual(2, budget.seq)
+		self.assertEqual(101., budget.last_pressed)
+
+class TestThumbnailCache(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_store_load(self):
+		cache = ThumbnailCache(self.path)
+
+		self.assertIsNone(cache.load('abc', 2, 1))
+
+		cache.store('abc', 2, 1, b'\x01\x02\x03\x04' * 2)
+		self.assertEqual(b'\x01\x02\x03\x04' * 2, cache.load('abc', 2, 1))
+
+		# Different size is a different thumbnail.
+		self.assertIsNone(cache.load('abc', 4, 2))
+
+	def test_corrupt(self):
+		cache = ThumbnailCache(self.path)
+
+		cache.store('abc', 1, 1, b'\x00' * 4)
+		with open(cache._get_filename('abc', 1, 1), 'wb') as f:
+			f.write(b'garbage')
+
+		self.assertIsNone(cache.load('abc', 1, 1))
+
+class TestContactSheetLayout(unittest.TestCase):
+	def test_grid(self):
+		w, h, pos = get_contact_sheet_layout(5, 2, 10, 5, padding=1)
+
+		self.assertEqual(2*11 + 1, w)
+		self.assertEqual(3*6 + 1, h)
+		self.assertEqual([ (1, 1), (12, 1), (1, 7), (12, 7), (1, 13) ], pos)
+
+	def test_few_frames(self):
+		w, h, pos = get_contact_sheet_layout(2, 8, 10, 5, padding=0)
+
+		self.assertEqual((20, 5), (w, h))
+		self.assertEqual([ (0, 0), (10, 0) ], pos)
+
+class TestPlanSortMoves(unittest.TestCase):
+	def apply_moves(self, items, moves):
+		stack = list(items)
+		for i, position in moves:
+			stack.remove(items[i])
+			stack.insert(position, items[i])
+		return stack
+
+	def test_subsequence(self):
+		import itertools
+
+		rnd = random.Random(1)
+		for n in range(100):
+			N = rnd.randint(0, 7)
+			values = list(range(N))
+			rnd.shuffle(values)
+			weights = [ rnd.randint(1, 3) for i in range(N) ]
+
+			best = 0
+			for k in range(N + 1):
+				for c in itertools.combinations(range(N), k):
+					if all(values[a] < values[b] for a, b in zip(c, c[1:])):
+						best = max(best, sum(weights[i] for i in c))
+
+			result = get_heaviest_increasing_subsequence(values, weights)
+			self.assertEqual(sorted(result), result)
+			self.assertTrue(all(values[a] < values[b] for a, b in zip(result, result[1:])))
+			self.assertEqual(best, sum(weights[i] for i in result))
+
+	def test_sorted(self):
+		self.assertEqual([], plan_sort_moves([ 1, 2, 3 ]))
+		self.assertEqual([], plan_sort_moves([ 1, None, 3, None ]))
+		self.assertEqual([], plan_sort_moves([]))
+
+	def test_one_out_of_place(self):
+		keys = [ 1, 2, 7, 3, 4, 5, 6 ]
+		moves = plan_sort_moves(keys)
+
+		self.assertEqual(1, len(moves))
+		self.assertEqual(sorted(keys), self.apply_moves(keys, moves))
+
+	def test_fixed(self):
+		keys = [ 3, None, 2, 1, None ]
+		moves = plan_sort_moves(keys)
+
+		items = list(range(len(keys)))
+		stack = self.apply_moves(items, moves)
+		self.assertEqual([ 3, 1, 2, 0, 4 ], stack)
+
+		moved = set(i for i, position in moves)
+		self.assertFalse(1 in moved)
+		self.assertFalse(4 in moved)
+
+	def test_random(self):
+		rnd = random.Random(1)
+		for n in range(200):
+			N = rnd.randint(0, 30)
+			keys = [ rnd.randint(0, 10) if rnd.random() < .8 else None
+					for i in range(N) ]
+			moves = plan_sort_moves(keys)
+
+			items = list(range(N))
+			stack = self.apply_moves(items, moves)
+
+			# fixed items stay in place
+			for i in items:
+				if keys[i] is None:
+					self.assertEqual(i, stack.index(i))
+
+			# others are sorted, stable for equal keys
+			sortable = [ i for i in stack if keys[i] is not None ]
+			self.assertEqual(sorted(sortable, key=lambda i: (keys[i], i)), sortable)
+
+			# Without fixed items, everything except the longest
+			# sorted subsequence is moved.
+			if None not in keys:
+				lis = get_heaviest_increasing_subsequence(
+						[ stack.index(i) for i in items ], [ 1 ] * N)
+				self.assertEqual(N - len(lis), len(moves))
+
+	def test_nearly_sorted(self):
+		rnd = random.Random(1)
+		keys = list(range(2000))
+		for n in range(3):
+			i = rnd.randrange(len(keys))
+			keys.insert(rnd.randrange(len(keys)), keys.pop(i))
+
+		moves = plan_sort_moves(keys)
+		self.assertTrue(len(moves) <= 3)
+		self.assertEqual(sorted(keys), self.apply_moves(keys, moves))
 
 class TestFlocked(unittest.TestCase):
 	def test_flock(self):